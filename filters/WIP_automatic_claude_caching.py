@@ -4,14 +4,166 @@ author: thiswillbeyourgithub
 author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
 date: 2024-10-11
-version: 0.0 (not yet working)
-description: the inlet is used to automatically replace the system prompt by a cached system prompt.
+version: 0.2.1
+description: the inlet automatically places anthropic's prompt caching breakpoints on the tools, the system prompt and the stable part of the chat history. The outlet keeps track of the cache hits per model, user and chat.
 license: GPLv3
 """
 
 import re
+import json
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+from collections import OrderedDict
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Optional, List, Callable, Any
+
+MAX_CHATS = 1000
+CACHE_CONTROL = {"type": "ephemeral"}
+DIMENSIONS = ("model", "user", "chat")
+# requests, requests with a cache hit, uncached input tokens, tokens read from the cache, tokens written to the cache
+COUNTERS = ("requests", "hits", "uncached", "read", "written")
+
+
+def estimate_tokens(obj) -> int:
+    "rough number of tokens of a message or tool, about 4 characters per token"
+    if isinstance(obj, str):
+        return len(obj) // 4
+    return len(json.dumps(obj, default=str)) // 4
+
+
+def prefix_hashes(messages: list) -> List[str]:
+    "hash of each prefix of messages, so that two lists can be compared message by message"
+    hashes = []
+    h = hashlib.sha256()
+    for m in messages:
+        h.update(json.dumps(m, sort_keys=True, default=str).encode())
+        hashes.append(h.copy().hexdigest())
+    return hashes
+
+
+def add_cache_control(message: dict) -> None:
+    "put a breakpoint at the end of message"
+    content = message.get("content")
+    if isinstance(content, str):
+        message["content"] = [{"type": "text", "text": content, "cache_control": CACHE_CONTROL}]
+    elif isinstance(content, list) and content:
+        content[-1]["cache_control"] = CACHE_CONTROL
+    elif isinstance(content, dict):
+        message["content"] = [dict(content, cache_control=CACHE_CONTROL)]
+    else:
+        raise Exception(f"Unexpected message content: '{message}'")
+
+
+def cache_usage(usage: dict) -> Optional[tuple]:
+    "uncached, read and written input tokens of an anthropic or openai style usage, None if unknown"
+    if not isinstance(usage, dict):
+        return None
+    read = usage.get("cache_read_input_tokens") or (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    written = usage.get("cache_creation_input_tokens") or 0
+    if "prompt_tokens" in usage:
+        # openai style, as sent by litellm: the prompt tokens include the cache
+        uncached = max(0, usage["prompt_tokens"] - read - written)
+    elif "input_tokens" in usage:
+        uncached = usage["input_tokens"]
+    else:
+        return None
+    return uncached, read, written
+
+
+class CacheAccounting:
+    """Prompt cache counters by model, user and chat.
+
+    The totals since startup are kept in memory, bounded to max_keys
+    per dimension. The increments are added to a sqlite database in WAL
+    mode every persist_interval seconds, so the summary covers all the
+    workers and restarts.
+    """
+
+    def __init__(self, path: Path, max_keys: int, persist_interval: float):
+        self.path = path
+        self.max_keys = max_keys
+        self.persist_interval = persist_interval
+        self.totals = {dim: OrderedDict() for dim in DIMENSIONS}
+        self.pending = {}
+        self.conn = None  # opened on first use, not at import time
+        self.last_persist = time.time()
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=5,
+                isolation_level=None,  # we handle the transactions
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_stats (dimension TEXT NOT NULL, key TEXT NOT NULL, "
+                + ", ".join(f"{c} INTEGER NOT NULL" for c in COUNTERS)
+                + ", updated REAL NOT NULL, PRIMARY KEY (dimension, key))"
+            )
+            self.conn = conn
+        return self.conn
+
+    def add(self, keys: dict, uncached: int, read: int, written: int) -> dict:
+        "count a request, keys mapping each dimension to its key, returns the in memory totals of each dimension"
+        delta = (1, int(read > 0), uncached, read, written)
+        out = {}
+        for dim, key in keys.items():
+            if key is None:
+                continue
+            totals = self.totals[dim]
+            totals[key] = [a + b for a, b in zip(totals.get(key, [0] * len(COUNTERS)), delta)]
+            totals.move_to_end(key)
+            while len(totals) > self.max_keys:
+                totals.popitem(last=False)
+            out[dim] = dict(zip(COUNTERS, totals[key]))
+            pending = self.pending.get((dim, key), [0] * len(COUNTERS))
+            self.pending[(dim, key)] = [a + b for a, b in zip(pending, delta)]
+        if time.time() - self.last_persist > self.persist_interval or len(self.pending) > self.max_keys:
+            self.persist()
+        return out
+
+    def persist(self) -> None:
+        "add the pending increments to the database"
+        self.last_persist = time.time()
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO cache_stats (dimension, key, " + ", ".join(COUNTERS) + ", updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                + "ON CONFLICT (dimension, key) DO UPDATE SET "
+                + ", ".join(f"{c} = {c} + excluded.{c}" for c in COUNTERS)
+                + ", updated = excluded.updated",
+                [(dim, key, *counters, self.last_persist) for (dim, key), counters in pending.items()],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def summary(self, dimension: str = "model", limit: int = 20) -> List[dict]:
+        "persisted counters of the most active keys of dimension, with their hit ratio"
+        assert dimension in DIMENSIONS, f"dimension must be one of {DIMENSIONS}"
+        self.persist()
+        rows = self.connect().execute(
+            "SELECT key, " + ", ".join(COUNTERS) + " FROM cache_stats WHERE dimension = ? ORDER BY requests DESC LIMIT ?",
+            (dimension, limit),
+        ).fetchall()
+        out = []
+        for key, *counters in rows:
+            d = dict(zip(COUNTERS, counters), key=key)
+            prompt = d["uncached"] + d["read"] + d["written"]
+            d["hit_ratio"] = d["hits"] / d["requests"] if d["requests"] else 0
+            d["read_ratio"] = d["read"] / prompt if prompt else 0
+            out.append(d)
+        return out
 
 
 class Filter:
@@ -23,77 +175,200 @@ class Filter:
             default=True,
             description="True to automatically cache the system prompt"
         )
+        cache_tools: bool = Field(
+            default=True,
+            description="True to automatically cache the tool definitions"
+        )
+        cache_history: bool = Field(
+            default=True,
+            description="True to automatically cache the part of the chat history that did not change since the previous turn, and the whole history for the next turn"
+        )
+        max_breakpoints: int = Field(
+            default=4,
+            description="Maximum number of cache breakpoints per request, anthropic allows 4",
+        )
+        min_cache_tokens: int = Field(
+            default=1024,
+            description="Don't place a breakpoint if the prompt up to it is shorter than that many tokens (estimated). Anthropic does not cache prompts below 1024 tokens (2048 for haiku).",
+        )
         regex_model: str = Field(
             default="anthropic|claude|sonnet|haiku|opus",
             description="If that regex matches the model name, we cache the system prompt. Regex flags are IGNORECASE and DOTALL. Leave empty to always try to cache.",
         )
+        track_cache_usage: bool = Field(
+            default=True,
+            description="Read the cache tokens from the usage of the answers and keep statistics per model, user and chat",
+        )
+        show_cache_status: bool = Field(
+            default=True,
+            description="Show the cache hits and estimated savings in the status after each answer",
+        )
+        stats_path: str = Field(
+            default="./claude_caching.stats.sqlite",
+            description="Path of the sqlite database of the cache statistics",
+        )
+        persist_interval: int = Field(
+            default=60,
+            description="Seconds between two writes of the cache statistics to the database",
+        )
+        input_price_per_mtok: float = Field(
+            default=3.0,
+            description="Price in $ per million uncached input tokens, to estimate the savings. Cache reads cost 10% of it and cache writes 125%.",
+        )
+        ms_per_1k_uncached_tokens: float = Field(
+            default=100,
+            description="Rough time to first token added by 1000 uncached input tokens, to estimate the latency saved by the cache reads",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
-        self.p("Init:start")
-        self.regex_model = re.compile(self.valves.regex_model, flags=re.DOTALL|re.IGNORECASE)
-        self.p("Init:done")
-        pass
+        # prefix hashes of the messages of the previous request of each chat
+        self.previous = OrderedDict()
+        # usage seen by the stream hook, by message_id, until the outlet
+        self.usages = OrderedDict()
+        self.accounting = None
+
+    def plan(self, body: dict, chat_id: Optional[str]) -> list:
+        """Where to put the breakpoints, as a list of (segment, index).
+
+        The segments are in prompt order: "tools", "system", "stable"
+        (the end of the history already sent at the previous turn) and
+        "last" (the end of the history, to be read at the next turn).
+        """
+        messages = body["messages"]
+        candidates = []
+        prefix = 0  # tokens of the prompt up to the candidate
+
+        tools = body.get("tools") or []
+        prefix += sum(estimate_tokens(t) for t in tools)
+        if self.valves.cache_tools and tools:
+            candidates.append(("tools", len(tools) - 1, prefix))
+
+        system = [i for i, m in enumerate(messages) if m.get("role") == "system"]
+        # anthropic takes the system messages out of the history
+        prefix += sum(estimate_tokens(messages[i].get("content")) for i in system)
+        if self.valves.cache_system_prompt and system:
+            candidates.append(("system", system[-1], prefix))
+
+        if self.valves.cache_history:
+            history = [i for i, m in enumerate(messages) if m.get("role") != "system"]
+            hashes = prefix_hashes([messages[i] for i in history])
+            stable = 0
+            if chat_id is not None:
+                for old, new in zip(self.previous.get(chat_id, ()), hashes):
+                    if old != new:
+                        break
+                    stable += 1
+                self.previous[chat_id] = hashes
+                self.previous.move_to_end(chat_id)
+                while len(self.previous) > MAX_CHATS:
+                    self.previous.popitem(last=False)
+
+            for n, i in enumerate(history, start=1):
+                prefix += estimate_tokens(messages[i].get("content"))
+                if n == stable and n < len(history):
+                    candidates.append(("stable", i, prefix))
+            if history:
+                candidates.append(("last", history[-1], prefix))
+
+        plan = []
+        for segment, index, prefix in candidates:
+            # anthropic's minimum applies to the whole prefix up to the breakpoint
+            if prefix < self.valves.min_cache_tokens:
+                self.p(f"plan: skipping the {segment} breakpoint, too short")
+                continue
+            plan.append((segment, index))
+        # keep the last ones, they cover the most tokens
+        return plan[-self.valves.max_breakpoints:] if self.valves.max_breakpoints else []
 
     def inlet(
         self,
         body: dict,
         __user__: Optional[dict] = None,
-        # __task__: Optional[dict] = None,
-        # __task_body__: Optional[dict] = None,
+        __metadata__: Optional[dict] = None,
         ) -> dict:
-        "reduce token count by removing thoughts in the previous messages"
+        "place anthropic's prompt caching breakpoints"
         self.p("inlet:start")
 
-        if not self.valves.cache_system_prompt:
-            self.p("inlet: disabled by valves")
-            return body
-
+        model = body.get("model", "")
         if self.valves.regex_model:
-            model = body["model"]
-            if not self.regex_model.match(model):
+            if not re.match(self.valves.regex_model, model, flags=re.DOTALL | re.IGNORECASE):
                 self.p(f"inlet: Regex for model does not think this model should be cached. Bypassing cachg. Model: '{model}'")
                 return body
-        # self.p(__task__)
-        # self.p(__task_body__)
 
-        if not any(m["role"] == "system" for m in body["messages"]):
-            raise Exception(self.p("No system message found in the chat."))
+        plan = self.plan(body, (__metadata__ or {}).get("chat_id"))
+        if not plan:
+            self.p("inlet: No message were cached!")
+            return body
 
-        self.p(f"inlet: Using anthropic's prompt caching for model {model}")
-        modified = False
-        for i, m in enumerate(body["messages"]):
-            if m["role"] != "system":
-                continue
-            if isinstance(m["content"], str):
-                sys_prompt = m["content"]
-            elif isinstance(m["content"], list):
-                sys_prompt = ""
-                for ii, mm in enumerate(m["content"]):
-                    sys_prompt += mm["text"]
-            elif isinstance(m["content"], dict):
-                sys_prompt = m["content"]["text"]
+        self.p(f"inlet: Using anthropic's prompt caching for model {model}: {plan}")
+        for segment, index in plan:
+            if segment == "tools":
+                body["tools"][index]["cache_control"] = CACHE_CONTROL
             else:
-                raise Exception(f"Unexpected system message: '{m}'")
-
-            self.p(f"Will use prompt caching for that message: '{sys_prompt}'")
-            body["messages"][i] = {
-                "role": "system",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": sys_prompt,
-                        "cache_control": {"type": "ephemeral"},
-                    }
-                ],
-            }
-            modified = True
-
-        if not modified:
-            self.p("inlet: No message were cached!")
+                add_cache_control(body["messages"][index])
         self.p("inlet:done")
         return body
 
+    def stream(self, event: dict, __metadata__: Optional[dict] = None) -> dict:
+        "keep the usage of the last chunk for the outlet"
+        if self.valves.track_cache_usage and event.get("usage"):
+            key = (__metadata__ or {}).get("message_id") or event.get("id")
+            self.usages[key] = event["usage"]
+            while len(self.usages) > MAX_CHATS:
+                self.usages.popitem(last=False)
+        return event
+
+    async def outlet(
+        self,
+        body: dict,
+        __user__: Optional[dict] = None,
+        __metadata__: Optional[dict] = None,
+        __event_emitter__: Callable[[dict], Any] = None,
+        ) -> dict:
+        "count the cache hits of the answer"
+        if not self.valves.track_cache_usage:
+            return body
+        metadata = __metadata__ or {}
+        usage = self.usages.pop(metadata.get("message_id"), None)
+        if usage is None and body.get("messages"):
+            usage = body["messages"][-1].get("usage")
+        tokens = cache_usage(usage)
+        if tokens is None:
+            self.p("outlet: No usage found in the answer")
+            return body
+        uncached, read, written = tokens
+
+        path = Path(self.valves.stats_path)
+        if self.accounting is None or self.accounting.path != path:
+            self.accounting = CacheAccounting(path=path, max_keys=MAX_CHATS, persist_interval=self.valves.persist_interval)
+        self.accounting.persist_interval = self.valves.persist_interval
+        model = body.get("model") or metadata.get("model", {}).get("id")
+        totals = self.accounting.add(
+            {"model": model, "user": (__user__ or {}).get("id"), "chat": metadata.get("chat_id")},
+            uncached,
+            read,
+            written,
+        )
+
+        if self.valves.show_cache_status:
+            price = self.valves.input_price_per_mtok / 1e6
+            saved = read * price * 0.9 - written * price * 0.25
+            prompt = uncached + read + written
+            message = f"Prompt cache: {read} tokens read ({read / max(prompt, 1):.0%} of the prompt), {written} written, saved ~${saved:.4f} and ~{read / 1000 * self.valves.ms_per_1k_uncached_tokens / 1000:.1f}s"
+            if "model" in totals:
+                t = totals["model"]
+                message += f" | {model}: {t['hits']}/{t['requests']} requests hit the cache"
+            self.p(f"outlet: {message}")
+            await EventEmitter(__event_emitter__).success_update(message)
+        return body
+
+    def summary(self, dimension: str = "model", limit: int = 20) -> List[dict]:
+        "persisted cache statistics of the most active models, users or chats"
+        if self.accounting is None:
+            self.accounting = CacheAccounting(path=Path(self.valves.stats_path), max_keys=MAX_CHATS, persist_interval=self.valves.persist_interval)
+        return self.accounting.summary(dimension=dimension, limit=limit)
+
     def p(self, message: str) -> str:
         "log message to logs"
         m = "AutomaticClaudeCachingFilter:outlet:" + str(message)
@@ -101,3 +376,29 @@ class Filter:
             print(m)
         return m
 
+
+class EventEmitter:
+    def __init__(self, event_emitter: Callable[[dict], Any] = None):
+        self.event_emitter = event_emitter
+
+    async def progress_update(self, description):
+        await self.emit(description)
+
+    async def error_update(self, description):
+        await self.emit(description, "error", True)
+
+    async def success_update(self, description):
+        await self.emit(description, "success", True)
+
+    async def emit(self, description="Unknown State", status="in_progress", done=False):
+        if self.event_emitter:
+            await self.event_emitter(
+                {
+                    "type": "status",
+                    "data": {
+                        "status": status,
+                        "description": description,
+                        "done": done,
+                    },
+                }
+            )
@@ -4,7 +4,7 @@ author: thiswillbeyourightub
 author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 git_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
-version: 1.1.2
+version: 1.4.2
 date: 2024-08-29
 license: GPLv3
 description: A Filter that adds user and other type of metadata to the requests. Made for litellm set to use langfuse callbacks.
@@ -15,6 +15,7 @@ from pydantic import BaseModel, Field
 from typing import Optional, Callable, Any
 import json
 from functools import cache
+import copy
 
 
 @cache
@@ -27,8 +28,29 @@ def load_json_dict(user_value: str) -> dict:
     return loaded
 
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def to_json(obj: Any) -> str:
+    """json dump obj in a single pass, turning the values of unknown types
+    into strings instead of failing. Uses orjson if it is installed."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        try:
+            return orjson.dumps(obj, default=str, option=option).decode()
+        except TypeError:  # for example integers larger than 64 bits
+            pass
+    try:
+        return json.dumps(obj, default=str, ensure_ascii=False)
+    except (TypeError, ValueError):  # non str keys, circular references
+        return str(obj)
+
+
 class Filter:
-    VERSION: str = "1.1.2"
+    VERSION: str = "1.4.2"
 
     class Valves(BaseModel):
         priority: int = Field(
@@ -51,12 +73,31 @@ class Filter:
             default=False,
             description="True to add emitter prints and set debug_langfuse metadata to True",
         )
+        compact_metadata: bool = Field(
+            default=False,
+            description="True to only send a compact metadata block: tags set once, only the whitelisted fields, within metadata_max_bytes, without the trace_metadata and extra_body copies",
+        )
+        metadata_fields: list = Field(
+            default=["chat_id", "message_id", "session_id", "tool_ids", "features"],
+            description="Only used if compact_metadata is True. Keys of the metadata of openwebui to keep, by order of importance.",
+        )
+        userinfo_fields: list = Field(
+            default=["id", "name", "email", "role"],
+            description="Only used if compact_metadata is True. Keys of the '__user__' dict of openwebui to keep.",
+        )
+        metadata_max_bytes: int = Field(
+            default=4096,
+            description="Only used if compact_metadata is True. The fields of metadata_fields that would make the metadata larger than that many bytes once json dumped are left out, starting with the last ones.",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
+        # parts of the compact metadata that only depend on the valves
+        self.static_metadata = {}
+        self.static_key = None
 
     async def on_valves_updated(self):
-        load_json_dict(self.valves.extra_metadata)
+        self.compute_static_metadata()
 
     async def inlet(
         self,
@@ -74,26 +115,40 @@ class Filter:
         if __model__ is None:
             __model__ = {}
 
-        async def log(message: str):
-            if self.valves.debug:
-                print(f"AddMetadata filter: inlet: {message}")
-            if self.valves.debug:
-                await emitter.progress_update(message)
+        async def log(message: str, *args) -> None:
+            "print and emit message % args, formatted only if debug is True"
+            if not self.valves.debug:
+                return
+            if args:
+                message = message % args
+            print(f"AddMetadata filter: inlet: {message}")
+            await emitter.progress_update(message)
 
         if "metadata" not in body:
             body["metadata"] = {}
 
+        if self.valves.compact_metadata:
+            skipped = self.project_metadata(body, __user__, __metadata__)
+            if skipped:
+                await log("Fields left out to stay under metadata_max_bytes: %s", skipped)
+            await log("Metadata at the end of the inlet filter: %s", body["metadata"])
+            if self.valves.debug:
+                await emitter.success_update("Done")
+            return body
+
         # user
         if self.valves.add_userinfo:
             if "user" in body:
-                await log(f"User key already found in body: '{body['user']}'")
+                await log("User key already found in body: '%s'", body["user"])
                 if body["user"] != __user__["name"]:
                     await log(
-                        f"User key different than expected: '{body['user']}' vs '{__user__['name']}'"
+                        "User key different than expected: '%s' vs '%s'",
+                        body["user"],
+                        __user__["name"],
                     )
             new_value = f"{__user__['name']}_{__user__['email']}"
             body["user"] = new_value
-            await log(f"Added user metadata '{new_value}'")
+            await log("Added user metadata '%s'", new_value)
 
             body["metadata"]["open-webui_userinfo"] = __user__
             body["metadata"]["trace_user_id"] = new_value
@@ -108,7 +163,7 @@ class Filter:
                 body["metadata"]["tags"] = tags
                 await log("Set tags")
             body["metadata"]["tags"] = list(set(body["metadata"]["tags"]))
-            await log(f"Tags are now '{body['metadata']['tags']}'")
+            await log("Tags are now '%s'", body["metadata"]["tags"])
         else:
             await log("No tags specified")
 
@@ -131,7 +186,7 @@ class Filter:
             body["metadata"]["debug_langfuse"] = True
 
         metadata = __metadata__.copy()
-        metadata.update(load_json_dict(self.valves.extra_metadata))
+        metadata.update(copy.deepcopy(load_json_dict(self.valves.extra_metadata)))
         if not metadata:
             await log("No metadata specified")
         else:
@@ -141,31 +196,11 @@ class Filter:
         # also add as langfuse metadata
         body["metadata"]["trace_metadata"] = body["metadata"].copy()
 
-        try:
+        # only serialize the whole body if it is going to be printed
+        if self.valves.debug:
             await log("Metadata at the end of the inlet filter:")
-            await log(json.dumps(body))
-
-        # fix: some updates of openwebui can crash json dumping, so we filter out the culprit
-        except Exception as e:
-            if "Object of type " in str(e) and "is not JSON serializable" in str(e):
-                failed = []
-                for k in list(body.keys()):
-                    try:
-                        json.dumps(body[k])
-                    except Exception:
-                        failed.append(k)
-                assert failed, f"No culprit key found when json-dumping body: {body}"
-                body2 = body.copy()
-                for k in failed:
-                    body2[k] = str(body2[k])
-
-                await log(json.dumps(body2))
-                if self.valves.debug:
-                    await log(
-                        f"Failed to json dump the following body keys: {failed} with value '{body[k]}'"
-                    )
-            else:
-                raise
+            # some updates of openwebui put non serializable values in the body
+            await log(to_json(body))
 
         body["extra_body"] = {"metadata": body["metadata"]}
 
@@ -173,6 +208,74 @@ class Filter:
             await emitter.success_update("Done")
         return body
 
+    def compute_static_metadata(self) -> None:
+        "parse extra_metadata and the tags once, they only depend on the valves"
+        static = copy.deepcopy(load_json_dict(self.valves.extra_metadata))
+        static["tags"] = list(dict.fromkeys(self.valves.extra_tags))
+        static["version"] = self.VERSION
+        if self.valves.debug:
+            static["debug_langfuse"] = True
+        self.static_metadata = static
+        self.static_key = self.static_valves_key()
+
+    def static_valves_key(self) -> tuple:
+        # openwebui creates a new Valves object at each request, so compare the values
+        return (self.valves.extra_metadata, tuple(self.valves.extra_tags), self.valves.debug)
+
+    def get_static_metadata(self) -> dict:
+        "copy of the static metadata, that the request and the other filters can modify"
+        if self.static_key != self.static_valves_key():
+            # valves loaded from the database without calling on_valves_updated
+            self.compute_static_metadata()
+        return copy.deepcopy(self.static_metadata)
+
+    def project_metadata(self, body: dict, __user__: Optional[dict], __metadata__: dict) -> list:
+        """Replace body["metadata"] by its compact version, returns the keys
+        of metadata_fields left out because of metadata_max_bytes."""
+        metadata = self.get_static_metadata()
+        incoming = body["metadata"]
+        if incoming.get("tags"):
+            metadata["tags"] = list(dict.fromkeys(incoming["tags"] + metadata["tags"]))
+
+        if self.valves.add_userinfo and __user__:
+            user = f"{__user__['name']}_{__user__['email']}"
+            body["user"] = user
+            metadata["trace_user_id"] = user
+            metadata["open-webui_userinfo"] = {
+                k: __user__[k] for k in self.valves.userinfo_fields if k in __user__
+            }
+
+        # useful reference: https://docs.litellm.ai/docs/observability/langfuse_integration
+        last_content = body["messages"][-1]["content"]
+        name = last_content[:100] if isinstance(last_content, str) else ""
+        metadata["session_id"] = __metadata__.get("chat_id")
+        metadata["generation_name"] = name
+        metadata["generation_id"] = __metadata__.get("message_id")
+        metadata["trace_name"] = name
+
+        # then the whitelisted fields, as long as they fit in the budget
+        size = len(json.dumps(metadata, default=str))
+        skipped = []
+        for k in self.valves.metadata_fields:
+            if k in metadata:
+                continue
+            if k in __metadata__:
+                v = __metadata__[k]
+            elif k in incoming:
+                v = incoming[k]
+            else:
+                continue
+            # size of '"k": v' plus the separator
+            entry = len(json.dumps({k: v}, default=str))
+            if size + entry > self.valves.metadata_max_bytes:
+                skipped.append(k)
+                continue
+            metadata[k] = v
+            size += entry
+
+        body["metadata"] = metadata
+        return skipped
+
 
 class EventEmitter:
     def __init__(self, event_emitter: Callable[[dict], Any] = None):
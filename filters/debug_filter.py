@@ -4,7 +4,7 @@ author: thiswillbeyourightub
 author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 git_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
-version: 2.1.0
+version: 2.2.1
 date: 2025-02-21
 license: GPLv3
 description: Filter that prints argument as they pass through it. You can use it multiple times to debug another filter.
@@ -15,11 +15,50 @@ import json
 from pydantic import BaseModel, Field
 from typing import Optional, Callable, Any
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def truncate_strings(obj: Any, max_length: int) -> Any:
+    "copy of obj where the strings longer than max_length are truncated"
+    if isinstance(obj, str):
+        if len(obj) <= max_length:
+            return obj
+        return obj[:max_length] + f"[...{len(obj) - max_length} more characters]"
+    if isinstance(obj, dict):
+        return {k: truncate_strings(v, max_length) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [truncate_strings(v, max_length) for v in obj]
+    return obj
+
+
+def to_json(obj: Any, indent: bool = False, max_length: int = 0) -> str:
+    """json dump obj in a single pass, turning the values of unknown types
+    into strings instead of failing. If max_length is not 0, longer strings
+    are truncated. Uses orjson if it is installed."""
+    if max_length:
+        obj = truncate_strings(obj, max_length)
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=str, option=option).decode()
+        except TypeError:  # for example integers larger than 64 bits
+            pass
+    try:
+        return json.dumps(obj, default=str, ensure_ascii=False, indent=2 if indent else None)
+    except (TypeError, ValueError):  # non str keys, circular references
+        return str(obj)
+
+
 def p(message: str) -> None:
     print(f"DebugFilter: {message}")
 
 class Filter:
-    VERSION: "2.1.0"
+    VERSION: "2.2.1"
     class Valves(BaseModel):
         priority: int = Field(
             default=0,
@@ -53,6 +92,10 @@ class Filter:
             default="both",
             description="When to print debug info: 'inlet', 'outlet', or 'both'",
         )
+        max_string_length: int = Field(
+            default=0,
+            description="Truncate the strings longer than that when printing, for example the base64 images. 0 to disable.",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
@@ -79,10 +122,7 @@ class Filter:
         if self.valves.direction in ["inlet", "both"]:
             for arg, should_print in args_to_print.items():
                 if should_print:
-                    try:
-                        val = json.dumps(locals()[arg], ensure_ascii=False, indent=2)
-                    except:
-                        val = str(locals()[arg])
+                    val = to_json(locals()[arg], indent=True, max_length=self.valves.max_string_length)
                     p(f"\nINLET_{prio}: {arg}:\n{val}")
         return body
 
@@ -108,9 +148,6 @@ class Filter:
         if self.valves.direction in ["outlet", "both"]:
             for arg, should_print in args_to_print.items():
                 if should_print:
-                    try:
-                        val = json.dumps(locals()[arg], ensure_ascii=False, indent=2)
-                    except:
-                        val = str(locals()[arg])
+                    val = to_json(locals()[arg], indent=True, max_length=self.valves.max_string_length)
                     p(f"\nOUTLET_{prio}: {arg}:\n{val}")
         return body
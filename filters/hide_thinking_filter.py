@@ -5,14 +5,23 @@ author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filte
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
 git_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
 date: 2024-10-11
-version: 0.6
-description: the inlet removes thinking xml tags to reduce token count, the outlet turns the <thinking> xml tags into <details> takes to make them display nicely.
+version: 0.9.1
+description: the inlet removes thinking xml tags to reduce token count, the stream hook (or the outlet if not streaming) turns the <thinking> xml tags into <details> takes to make them display nicely.
 license: GPLv3
 """
 
 import re
 from pydantic import BaseModel, Field
 from typing import Optional
+from collections import OrderedDict
+
+CONVERTED_START = "<details>"
+CONVERTED_SUMMARY = "<summary>Reasonning</summary>"
+CONVERTED_STOP = "</details>"
+WHITESPACE = re.compile(r"\s*")
+OPEN_WITH = "<details>\n<summary>Reasonning</summary>\n\n"
+CLOSE_WITH = "\n\n</details>\n"
+MAX_STREAMS = 100
 
 
 class Filter:
@@ -22,38 +31,83 @@ class Filter:
         )
         start_thought: str = Field(
             default="<thinking>",
-            description="Start of a thought block. Note that any whitespace following the pattern will be considered part of the pattern. The applied regex flags are re.DOTALL and re.MULTILINE"
+            description="Start of a thought block. Any whitespace following it will be considered part of the thought.",
         )
         stop_thought: str = Field(
             default="</thinking>",
-            description="End of thought block Note that any whitespace preceding the pattern will be considered part of the pattern. The applied regex flags are re.DOTALL and re.MULTILINE",
+            description="End of thought block. Any whitespace preceding it will be considered part of the thought.",
+        )
+        use_regex: bool = Field(
+            default=False,
+            description="If True, start_thought and stop_thought are regex patterns, applied with the flags re.DOTALL and re.MULTILINE. Slower, and can backtrack a lot on unclosed blocks.",
         )
 
     def __init__(self):
         self.valves = self.Valves()
-        self.p("Init:start")
+        # transformer of each message being streamed, and messages already converted
+        self.transformers = OrderedDict()
+        self.streamed = OrderedDict()
+
+    def remove_thought(self, text: str) -> str:
+        "remove thoughts"
+        self.p("remove_thought: start")
+        if self.valves.use_regex:
+            return self.remove_thought_regex(text)
 
-        self.start_thought = re.compile(self.valves.start_thought + r"\s*", flags=re.DOTALL | re.MULTILINE)
-        self.stop_thought = re.compile(r"\s*" + self.valves.stop_thought, flags=re.DOTALL | re.MULTILINE)
+        start = self.valves.start_thought
+        stop = self.valves.stop_thought
+        out = []
+        pos = 0
+        next_thought = text.find(start)
+        next_details = text.find(CONVERTED_START)
+        while next_thought != -1 or next_details != -1:
+            if next_details == -1 or (next_thought != -1 and next_thought < next_details):
+                end = text.find(stop, next_thought + len(start))
+                if end == -1:
+                    # unclosed, so no later block can be closed either
+                    next_thought = -1
+                    continue
+                out.append(text[pos:next_thought])
+                pos = end + len(stop)
+            else:
+                after = WHITESPACE.match(text, next_details + len(CONVERTED_START)).end()
+                if not text.startswith(CONVERTED_SUMMARY, after):
+                    next_details = text.find(CONVERTED_START, after)
+                    continue
+                end = text.find(CONVERTED_STOP, after)
+                if end == -1:
+                    next_details = -1
+                    continue
+                out.append(text[pos:next_details])
+                pos = end + len(CONVERTED_STOP)
+            # search again for the delimiters that are now inside a removed block
+            if next_thought != -1 and next_thought < pos:
+                next_thought = text.find(start, pos)
+            if next_details != -1 and next_details < pos:
+                next_details = text.find(CONVERTED_START, pos)
+
+        if not out:
+            self.p("remove_thought: No thought to remove in text")
+            return text
+        assert text.strip(), "Received empty text"
+        out.append(text[pos:])
+        self.p("remove_thought: done")
+        return "".join(out)
 
-        self.pattern = re.compile(
+    def remove_thought_regex(self, text: str) -> str:
+        "remove thoughts, start_thought and stop_thought being regex patterns"
+        pattern = re.compile(
             rf"{self.valves.start_thought}(.*?){self.valves.stop_thought}",
             flags=re.DOTALL | re.MULTILINE,
         )
-        self.converted_pattern = re.compile(r"<details>\s*<summary>Reasonning</summary>.*?</details>", flags=re.DOTALL | re.MULTILINE)
-        self.p("Init:done")
-        pass
-
-    def remove_thought(self, text: str) -> str:
-        "remove thoughts"
-        self.p("remove_thought: start")
-        if not (self.pattern.search(text) or self.converted_pattern.search(text)):
+        converted_pattern = re.compile(r"<details>\s*<summary>Reasonning</summary>.*?</details>", flags=re.DOTALL | re.MULTILINE)
+        if not (pattern.search(text) or converted_pattern.search(text)):
             self.p("remove_thought: No thought to remove in text")
             return text
         assert text.strip(), "Received empty text"
-        step1 = self.pattern.sub("", text)
+        step1 = pattern.sub("", text)
         assert step1, "Empty text after step 1 of thought removal"
-        step2 = self.converted_pattern.sub("", text)
+        step2 = converted_pattern.sub("", step1)
         assert step2, "Empty text after step 2 of thought removal"
         self.p("remove_thought: done")
         return step2
@@ -61,13 +115,45 @@ class Filter:
     def hide_thought(self, text: str) -> str:
         "put the thoughts in <details> tags"
         self.p("hide_thought: start")
-        match = self.pattern.search(text)
+        if self.valves.use_regex:
+            return self.hide_thought_regex(text)
+
+        start = self.valves.start_thought
+        stop = self.valves.stop_thought
+        out = []
+        pos = 0
+        idx = text.find(start)
+        while idx != -1:
+            end = text.find(stop, idx + len(start))
+            if end == -1:
+                break
+            out.append(text[pos:idx])
+            out.append(OPEN_WITH)
+            out.append(text[idx + len(start):end].strip())
+            out.append(CLOSE_WITH)
+            pos = end + len(stop)
+            idx = text.find(start, pos)
+
+        if not out:
+            self.p("hide_thought: No thought to hide in text")
+            return text
+        out.append(text[pos:])
+        self.p("hide_thought: done")
+        return "".join(out)
+
+    def hide_thought_regex(self, text: str) -> str:
+        "put the thoughts in <details> tags, start_thought and stop_thought being regex patterns"
+        pattern = re.compile(
+            rf"{self.valves.start_thought}(.*?){self.valves.stop_thought}",
+            flags=re.DOTALL | re.MULTILINE,
+        )
+        match = pattern.search(text)
         if not match:
             self.p("hide_thought: No thought to hide in text")
             return text
         section = match.group()
-        section = self.start_thought.sub("<details>\n<summary>Reasonning</summary>\n\n", section)
-        section = self.stop_thought.sub("\n\n</details>\n", section)
+        section = re.sub(self.valves.start_thought + r"\s*", "<details>\n<summary>Reasonning</summary>\n\n", section, flags=re.DOTALL | re.MULTILINE)
+        section = re.sub(r"\s*" + self.valves.stop_thought, "\n\n</details>\n", section, flags=re.DOTALL | re.MULTILINE)
         newtext = text.replace(match.group(), section)
         self.p("hide_thought: done")
         return newtext
@@ -95,15 +181,53 @@ class Filter:
                     if new != m["content"]:
                         modified += 1
                     body["messages"][im]["content"] = new
-        self.p(f"inlet:done: modified {modified} messages")
+        self.p("inlet:done: modified %s messages", modified)
         return body
 
+    def stream(self, event: dict, __metadata__: Optional[dict] = None) -> dict:
+        "put the thoughts in <details> tags as the chunks are streamed"
+        if self.valves.use_regex:
+            return event  # the outlet will do it
+        key = (__metadata__ or {}).get("message_id") or event.get("id")
+        for choice in event.get("choices") or []:
+            delta = choice.get("delta") or {}
+            content = delta.get("content")
+            if key not in self.transformers:
+                if not content:
+                    continue
+                self.transformers[key] = ThoughtTransformer(
+                    start=self.valves.start_thought,
+                    stop=self.valves.stop_thought,
+                    open_with=OPEN_WITH,
+                    close_with=CLOSE_WITH,
+                )
+                # forget the streams that were never finished
+                while len(self.transformers) > MAX_STREAMS:
+                    self.transformers.popitem(last=False)
+            transformer = self.transformers[key]
+            if content:
+                delta["content"] = transformer.feed(content)
+            if choice.get("finish_reason"):
+                # the last chunk can have a null content along with the finish_reason
+                delta["content"] = (delta.get("content") or "") + transformer.flush()
+                choice["delta"] = delta
+                del self.transformers[key]
+                self.streamed[key] = transformer.closed
+                while len(self.streamed) > MAX_STREAMS:
+                    self.streamed.popitem(last=False)
+        return event
+
     async def outlet(
         self,
         body: dict,
         __user__: Optional[dict] = None,
+        __metadata__: Optional[dict] = None,
     ) -> dict:
-        self.p(f"outlet:{__user__}")
+        self.p("outlet:%s", __user__)
+        key = (__metadata__ or {}).get("message_id")
+        if key in self.streamed:
+            self.p("outlet:done: %s thoughts already converted while streaming", self.streamed.pop(key))
+            return body
         # self.p(f"outlet:content:{body['messages'][-1]['content']}")
         # self.p(f"outlet:user:{__user__}")
         # self.p(str(body)
@@ -138,10 +262,73 @@ class Filter:
         else:
             raise Exception(f"outlet: Unexpected type of last_message: {type(last_message)}")
 
-        self.p(f"outlet:done: modified {modified} messages")
+        self.p("outlet:done: modified %s messages", modified)
         return body
 
-    def p(self, message: str) -> None:
-        "log message to logs"
-        if self.valves.verbose:
-            print("ThinkingFilter:outlet:" + str(message))
+    def p(self, message: str, *args) -> None:
+        "log message % args to logs, formatted only if verbose is True"
+        if not self.valves.verbose:
+            return
+        if args:
+            message = message % args
+        print("ThinkingFilter:outlet:" + str(message))
+
+
+class ThoughtTransformer:
+    """Replace the delimiters of the thought blocks in a stream of text.
+
+    Each chunk is scanned once with str.find and only the end of the chunk
+    that is exactly the beginning of the delimiter we are waiting for is
+    held back, so memory stays bounded by the length of the delimiters
+    whatever the length of the answer.
+    """
+
+    def __init__(self, start: str, stop: str, open_with: str, close_with: str):
+        assert start, "Empty start delimiter"
+        assert stop, "Empty stop delimiter"
+        self.start = start
+        self.stop = stop
+        self.open_with = open_with
+        self.close_with = close_with
+        self.inside = False  # True when in a thought block
+        self.closed = 0  # number of thought blocks closed so far
+        self.tail = ""  # possible beginning of a delimiter
+
+    def feed(self, chunk: str) -> str:
+        "return the transformed part of chunk that can be shown to the user"
+        text = self.tail + chunk
+        self.tail = ""
+        out = []
+        pos = 0
+        while True:
+            delimiter = self.stop if self.inside else self.start
+            idx = text.find(delimiter, pos)
+            if idx == -1:
+                self.tail = self.partial_suffix(text, pos, delimiter)
+                out.append(text[pos:len(text) - len(self.tail)])
+                break
+            out.append(text[pos:idx])
+            pos = idx + len(delimiter)
+            if self.inside:
+                out.append(self.close_with)
+                self.closed += 1
+            else:
+                out.append(self.open_with)
+            self.inside = not self.inside
+        return "".join(out)
+
+    def flush(self) -> str:
+        "return what was held back and close an unfinished block, to call at the end of the stream"
+        tail, self.tail = self.tail, ""
+        if self.inside:
+            self.inside = False
+            return tail + self.close_with
+        return tail
+
+    @staticmethod
+    def partial_suffix(text: str, pos: int, delimiter: str) -> str:
+        "longest end of text[pos:] that is the beginning of delimiter"
+        for n in range(min(len(delimiter) - 1, len(text) - pos), 0, -1):
+            if delimiter.startswith(text[-n:]):
+                return text[-n:]
+        return ""
@@ -1,21 +1,224 @@
 """
 title: InfiniteChat
 author: thiswillbeyourgithub
-version: 1.2.0
+version: 1.5.2
 date: 2025-02-21
 author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 git_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
 license: GPLv3
-description: A filter that keeps chats manageable by retaining only the last N messages.
+description: A filter that keeps chats manageable by retaining only the last N messages, or the last messages that fit in a token budget. The dropped messages can be indexed to recall the most relevant ones.
 """
 
 from pydantic import BaseModel, Field
-from typing import Optional, Callable, Any
+from typing import Optional, Callable, Any, List, Tuple
+from collections import OrderedDict
+from pathlib import Path
+import re
+import sqlite3
+import time
+
+# about one token per word or punctuation sign, and a flat cost per image
+TOKEN_REGEX = re.compile(r"\w+|[^\w\s]")
+IMAGE_TOKENS = 800
+# the window starts of chats untouched for that long are forgotten
+WINDOW_TTL = 30 * 86400
+WORD_REGEX = re.compile(r"\w{3,}")
+MAX_QUERY_TERMS = 32
+
+
+class RecallIndex:
+    """Full text index of the messages dropped from the window, by chat_id.
+
+    Stored in a sqlite FTS5 table in WAL mode, ranked with its builtin
+    bm25. Only the messages dropped since the last turn are indexed. The
+    chats untouched for ttl seconds are evicted, at most once per minute.
+    """
+
+    def __init__(self, path: Path, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.conn = None  # opened on first use, not at import time
+        self.last_eviction = 0
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=5,
+                isolation_level=None,  # we handle the transactions
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            # chat_id is indexed to restrict the MATCH to a single chat
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(chat_id, idx UNINDEXED, role UNINDEXED, content)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chats (chat_id TEXT PRIMARY KEY, n_indexed INTEGER NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS chats_updated ON chats (updated)"
+            )
+            self.conn = conn
+        return self.conn
+
+    def add(self, chat_id: str, messages: list) -> int:
+        "index the messages not indexed yet among the dropped messages of chat_id, returns how many"
+        conn = self.connect()
+        self.evict()
+        now = time.time()
+        row = conn.execute(
+            "SELECT n_indexed, updated FROM chats WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        if len(messages) <= (row[0] if row else 0):
+            # nothing new was dropped, most turns: only keep the chat from
+            # being evicted, without rewriting its row at each turn
+            if row and now - row[1] > self.ttl / 10:
+                conn.execute(
+                    "UPDATE chats SET updated = ? WHERE chat_id = ?", (now, chat_id)
+                )
+            return 0
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # read again, another worker may have indexed them meanwhile
+            row = conn.execute(
+                "SELECT n_indexed FROM chats WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            n_indexed = row[0] if row else 0
+            new = [
+                (chat_id, idx, m.get("role", ""), text)
+                for idx, m in enumerate(messages[n_indexed:], start=n_indexed)
+                for text in [message_text(m)]
+                if text
+            ]
+            conn.executemany(
+                "INSERT INTO messages (chat_id, idx, role, content) VALUES (?, ?, ?, ?)",
+                new,
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO chats (chat_id, n_indexed, updated) VALUES (?, ?, ?)",
+                (chat_id, max(n_indexed, len(messages)), now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(new)
+
+    def search(self, chat_id: str, query: str, limit: int) -> List[Tuple[int, str, str]]:
+        "index, role and content of the most relevant messages of chat_id for query"
+        terms = list(dict.fromkeys(w.lower() for w in WORD_REGEX.findall(query)))[:MAX_QUERY_TERMS]
+        if not terms:
+            return []
+        match = 'chat_id:"%s" AND content:(%s)' % (
+            chat_id.replace('"', '""'),
+            " OR ".join('"%s"' % t.replace('"', '""') for t in terms),
+        )
+        # the weights make bm25 ignore the chat_id column
+        return self.connect().execute(
+            "SELECT idx, role, content FROM messages WHERE messages MATCH ? ORDER BY bm25(messages, 0.0, 0.0, 0.0, 1.0) LIMIT ?",
+            (match, limit),
+        ).fetchall()
+
+    def evict(self) -> None:
+        "delete the chats untouched for more than ttl"
+        now = time.time()
+        if now - self.last_eviction < 60:
+            return
+        self.last_eviction = now
+        conn = self.connect()
+        old = conn.execute(
+            "SELECT chat_id FROM chats WHERE updated < ?", (now - self.ttl,)
+        ).fetchall()
+        for (chat_id,) in old:
+            conn.execute(
+                "DELETE FROM messages WHERE messages MATCH ?",
+                ('chat_id:"%s"' % chat_id.replace('"', '""'),),
+            )
+            conn.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+
+
+class WindowStore:
+    """Index of the first message kept, by chat_id, for the token budget
+    hysteresis.
+
+    Stored in a sqlite database in WAL mode so that all the uvicorn
+    workers trim a chat at the same turns. A row is only written when the
+    window moves. The chats untouched for ttl seconds are evicted, at
+    most once per minute.
+    """
+
+    def __init__(self, path: Path, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.conn = None  # opened on first use, not at import time
+        self.last_eviction = 0
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=5,
+                isolation_level=None,  # single statements, autocommitted
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS windows (chat_id TEXT PRIMARY KEY, start INTEGER NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS windows_updated ON windows (updated)"
+            )
+            self.conn = conn
+        return self.conn
+
+    def get(self, chat_id: str) -> Optional[Tuple[int, float]]:
+        "start of the window of chat_id and when it was stored"
+        self.evict()
+        return self.connect().execute(
+            "SELECT start, updated FROM windows WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+
+    def put(self, chat_id: str, start: int, previous: Optional[Tuple[int, float]]) -> None:
+        "store start if it moved since previous, or if previous is about to be evicted"
+        now = time.time()
+        if previous and previous[0] == start and now - previous[1] < self.ttl / 10:
+            return
+        self.connect().execute(
+            "INSERT OR REPLACE INTO windows (chat_id, start, updated) VALUES (?, ?, ?)",
+            (chat_id, start, now),
+        )
+
+    def evict(self) -> None:
+        "delete the chats untouched for more than ttl"
+        now = time.time()
+        if now - self.last_eviction < 60:
+            return
+        self.last_eviction = now
+        self.connect().execute(
+            "DELETE FROM windows WHERE updated < ?", (now - self.ttl,)
+        )
+
+
+def message_text(message: dict) -> str:
+    "text of a message, be its content a str or a multimodal list"
+    content = message.get("content")
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "\n".join(
+            item["text"] for item in content
+            if isinstance(item, dict) and isinstance(item.get("text"), str)
+        )
+    return ""
 
 
 class Filter:
-    VERSION: str = "1.2.0"
+    VERSION: str = "1.5.2"
     class Valves(BaseModel):
         priority: int = Field(
             default=0,
@@ -29,9 +232,125 @@ class Filter:
             default=2,
             description="Number of most recent messages to keep in the chat. This does not count the system message.",
         )
+        token_budget: int = Field(
+            default=0,
+            description="If not 0, keep_messages is ignored and the most recent messages are kept as long as they fit in that many tokens (estimated). The last message and the system messages are always kept.",
+        )
+        cache_size: int = Field(
+            default=10000,
+            description="Number of token estimates of messages to remember so that only the new messages are estimated at each turn",
+        )
+        hysteresis: int = Field(
+            default=0,
+            description="Let the window grow by that many messages (or tokens if token_budget is set) before trimming it back to keep_messages (or token_budget). The beginning of the chat then stays the same for several turns, which lets the providers reuse their prompt cache. 0 to slide the window at every turn.",
+        )
+        window_path: str = Field(
+            default="./infinite_chat_windows.sqlite",
+            description="Path of the sqlite database of the window of each chat, used when both token_budget and hysteresis are set, shared by all the workers",
+        )
+        recall_top_k: int = Field(
+            default=0,
+            description="If not 0, the dropped messages are indexed on disk and up to that many of the most relevant to the last user message are added back to it. Requires the chat_id.",
+        )
+        recall_token_budget: int = Field(
+            default=500,
+            description="Maximum number of tokens (estimated) of the recalled messages",
+        )
+        recall_path: str = Field(
+            default="./infinite_chat_recall.sqlite",
+            description="Path of the sqlite database of the dropped messages",
+        )
+        recall_ttl_days: float = Field(
+            default=90,
+            description="The dropped messages of chats untouched for that many days are deleted",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.window_store = None
+        self.recall_index = None
+
+    def count_tokens(self, text: str) -> int:
+        "estimated number of tokens of text, memoized in a LRU cache keyed by its hash"
+        # hash() is faster than hashlib and good enough for an in memory cache
+        key = (hash(text), len(text))
+        if key in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.cache_misses += 1
+        n = len(TOKEN_REGEX.findall(text))
+        self.cache[key] = n
+        while len(self.cache) > self.valves.cache_size:
+            self.cache.popitem(last=False)
+        return n
+
+    def message_tokens(self, message: dict) -> int:
+        "estimated number of tokens of a message, be its content a str or a multimodal list"
+        content = message.get("content")
+        if isinstance(content, str):
+            return self.count_tokens(content)
+        n = 0
+        if isinstance(content, list):
+            for item in content:
+                if isinstance(item, dict) and isinstance(item.get("text"), str):
+                    n += self.count_tokens(item["text"])
+                else:
+                    n += IMAGE_TOKENS
+        return n
+
+    def fit_budget(self, messages: list, budget: int) -> int:
+        "number of most recent messages that fit in budget, at least 1"
+        used = 0
+        for n, m in enumerate(reversed(messages)):
+            used += self.message_tokens(m)
+            if used > budget:
+                return max(1, n)
+        return len(messages)
+
+    def window_start(self, messages: list, keep: int, chat_id: Optional[str]) -> int:
+        "index of the first message to keep"
+        n = len(messages)
+        if not self.valves.token_budget:
+            if not self.valves.hysteresis:
+                return max(0, n - keep)
+            # only depends on n: moves by steps of hysteresis messages
+            return max(0, (n - keep) // self.valves.hysteresis * self.valves.hysteresis)
+
+        budget = self.valves.token_budget
+        if not self.valves.hysteresis or chat_id is None:
+            return n - self.fit_budget(messages, budget)
+        path = Path(self.valves.window_path)
+        if self.window_store is None or self.window_store.path != path:
+            self.window_store = WindowStore(path=path, ttl=WINDOW_TTL)
+        previous = self.window_store.get(chat_id)
+        start = previous[0] if previous else 0
+        if start >= n or sum(self.message_tokens(m) for m in messages[start:]) > budget + self.valves.hysteresis:
+            start = n - self.fit_budget(messages, budget)
+        self.window_store.put(chat_id, start, previous)
+        return start
+
+    def recall(self, chat_id: str, dropped: list, last: dict) -> List[Tuple[int, str, str]]:
+        "index the dropped messages and return the index, role and content of the most relevant ones for the last message"
+        path = Path(self.valves.recall_path)
+        if self.recall_index is None or self.recall_index.path != path:
+            self.recall_index = RecallIndex(path=path, ttl=self.valves.recall_ttl_days * 86400)
+        self.recall_index.add(chat_id, dropped)
+
+        results = self.recall_index.search(chat_id, message_text(last), self.valves.recall_top_k)
+        recalled = []
+        used = 0
+        for idx, role, content in results:
+            n = self.count_tokens(content)
+            if used + n > self.valves.recall_token_budget:
+                continue
+            used += n
+            recalled.append((int(idx), role, content))
+        # in the order of the chat
+        return sorted(recalled)
 
     async def on_valves_updated(self):
         pass
@@ -41,10 +360,14 @@ class Filter:
         body: dict,
         __user__: Optional[dict] = None,
         __event_emitter__: Callable[[dict], Any] = None,
+        __metadata__: Optional[dict] = None,
         ) -> dict:
         # printer
         emitter = EventEmitter(__event_emitter__)
-        async def log(message: str):
+        async def log(message: str, *args):
+            "print if debug and emit message % args"
+            if args:
+                message = message % args
             if self.valves.debug:
                 print(f"InfiniteChat filter: inlet: {message}")
             await emitter.progress_update(message)
@@ -57,10 +380,26 @@ class Filter:
         sys_message = [m for m in body["messages"] if "role" in m and m["role"] == "system"]
 
         if self.valves.debug:
-            await log(f"InfiniteChat filter: inlet: messages count before: {len(body['messages'])}, including {len(sys_message)} system message(s)")
+            await log("InfiniteChat filter: inlet: messages count before: %s, including %s system message(s)", len(body["messages"]), len(sys_message))
 
         body["messages"] = [m for m in body["messages"] if ("role" not in m) or (m["role"] != "system")]
-        body["messages"] = sys_message + body["messages"][-keep:]
+        chat_id = (__metadata__ or {}).get("chat_id")
+        start = self.window_start(body["messages"], keep, chat_id)
+        if self.valves.debug and self.valves.token_budget:
+            await log("Token budget fits %s messages, cache hits: %s, misses: %s", len(body["messages"]) - start, self.cache_hits, self.cache_misses)
+        if self.valves.recall_top_k and chat_id and start > 0:
+            recalled = self.recall(chat_id, body["messages"][:start], body["messages"][-1])
+            if recalled:
+                await log("Recalled %s older messages", len(recalled))
+                recalled = "\n\n".join(f"[{role} #{idx}]: {content}" for idx, role, content in recalled)
+                # added to the last message to keep the beginning of the prompt cacheable
+                recalled = f"<older_messages_of_this_chat>\n{recalled}\n</older_messages_of_this_chat>\n\n"
+                last = body["messages"][-1]
+                if isinstance(last.get("content"), str):
+                    last["content"] = recalled + last["content"]
+                elif isinstance(last.get("content"), list):
+                    last["content"].insert(0, {"type": "text", "text": recalled})
+        body["messages"] = sys_message + body["messages"][start:]
 
         if self.valves.debug:
             await emitter.success_update(f"InfiniteChat filter: inlet: messages count after: {len(body['messages'])}")
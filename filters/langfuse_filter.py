@@ -4,13 +4,13 @@ author: thiswillbeyourightub
 author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 git_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
-version: 1.0.1
+version: 1.5.3
 date: 2025-02-21
 license: GPLv3
 description: A Filter that prints arguments as they go through it. Still a WIP because having issues with token counting, prices etc.
 openwebui_url: https://openwebui.com/f/qqqqqqqqqqqqqqqqqqqq/langfuse_filter
 ---
-requirements: langfuse>=2.59.3,filelock
+requirements: langfuse>=2.59.3
 ---
 """
 
@@ -18,21 +18,268 @@ from pathlib import Path
 import os
 import time
 import json
+import sqlite3
+import queue
+import uuid
+import hashlib
+import threading
 from pydantic import BaseModel, Field
-from typing import Optional, Callable, Any, List
+from typing import Optional, Callable, Any, List, Tuple
 from langfuse import Langfuse
 from datetime import datetime
-from filelock import FileLock
+from collections import deque
+
+BUFFER = Path("./langfuse_filter.buffer.sqlite")
+JSON_SCALARS = (str, int, float, bool, type(None))
+# below that the exporter thread would keep waking up for nothing
+MIN_FLUSH_INTERVAL = 0.1
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def to_json(obj: Any) -> str:
+    """json dump obj in a single pass, turning the values of unknown types
+    into strings instead of failing. Uses orjson if it is installed."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        try:
+            return orjson.dumps(obj, default=str, option=option).decode()
+        except TypeError:  # for example integers larger than 64 bits
+            pass
+    try:
+        return json.dumps(obj, default=str, ensure_ascii=False)
+    except (TypeError, ValueError):  # non str keys, circular references
+        return str(obj)
+
+
+class ChatStore:
+    """Start time of the requests and history already sent to langfuse,
+    by chat_id.
+
+    Stored in a sqlite database in WAL mode so that it is shared by all
+    the uvicorn workers without rewriting anything but the touched row.
+    Start times older than ttl seconds and histories untouched for
+    history_ttl seconds are evicted, at most once per minute.
+    """
+
+    def __init__(self, path: Path, ttl: int, history_ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self.history_ttl = history_ttl
+        self.conn = None  # opened on first use, not at import time
+        self.last_eviction = 0
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=5,
+                isolation_level=None,  # we handle the transactions
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS timings (chat_id TEXT PRIMARY KEY, t_start REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS timings_t_start ON timings (t_start)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS history (chat_id TEXT PRIMARY KEY, n_messages INTEGER NOT NULL, digest TEXT NOT NULL, trace_id TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS history_updated ON history (updated)"
+            )
+            self.conn = conn
+        return self.conn
+
+    def put(self, chat_id: str, t_start: float) -> Optional[float]:
+        "store the start time of chat_id, returns the previous one if any"
+        conn = self.connect()
+        self.evict()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            previous = conn.execute(
+                "SELECT t_start FROM timings WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO timings (chat_id, t_start) VALUES (?, ?)",
+                (chat_id, t_start),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return previous[0] if previous else None
+
+    def pop(self, chat_id: str) -> Optional[float]:
+        "remove and return the start time of chat_id, None if missing"
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT t_start FROM timings WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            if row:
+                conn.execute("DELETE FROM timings WHERE chat_id = ?", (chat_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row[0] if row else None
+
+    def get_history(self, chat_id: str) -> Optional[Tuple[int, str, str]]:
+        "number of messages, digest of those messages and trace_id of the last trace sent for chat_id"
+        return self.connect().execute(
+            "SELECT n_messages, digest, trace_id FROM history WHERE chat_id = ?",
+            (chat_id,),
+        ).fetchone()
+
+    def set_history(self, chat_id: str, n_messages: int, digest: str, trace_id: str) -> None:
+        self.connect().execute(
+            "INSERT OR REPLACE INTO history (chat_id, n_messages, digest, trace_id, updated) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, n_messages, digest, trace_id, time.time()),
+        )
+
+    def clear_history(self, chat_id: str) -> None:
+        "forget what was sent for chat_id, its next trace contains the whole history"
+        self.connect().execute("DELETE FROM history WHERE chat_id = ?", (chat_id,))
+
+    def evict(self) -> None:
+        "delete the entries older than the ttl"
+        now = time.time()
+        if now - self.last_eviction < 60:
+            return
+        self.last_eviction = now
+        conn = self.connect()
+        conn.execute(
+            "DELETE FROM timings WHERE t_start < ?", (now - self.ttl,)
+        )
+        conn.execute(
+            "DELETE FROM history WHERE updated < ?", (now - self.history_ttl,)
+        )
+
+
+class Exporter:
+    """Send the traces to langfuse from a background thread.
+
+    outlet only puts the arguments of the trace, span and generation in a
+    bounded queue. The thread creates them and flushes langfuse once per
+    batch: after batch_size traces or every flush_interval seconds. When
+    the queue is full, the oldest (or the newest) trace is dropped.
+    on_result is called from the thread with each trace and whether it
+    was flushed (True) or dropped or failed (False).
+    """
+
+    def __init__(
+        self,
+        langfuse: Langfuse,
+        max_size: int,
+        batch_size: int,
+        flush_interval: float,
+        drop_oldest: bool,
+        on_result: Optional[Callable[[dict, bool], None]] = None,
+    ):
+        self.langfuse = langfuse
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = max(MIN_FLUSH_INTERVAL, flush_interval)
+        self.drop_oldest = drop_oldest
+        self.on_result = on_result
+        # traces dropped by put, reported by the thread
+        self.rejected = deque()
+        self.dropped = 0
+        self.exported = 0
+        self.thread = threading.Thread(
+            target=self.run,
+            name="langfuse_filter_exporter",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def put(self, item: dict) -> bool:
+        "queue a trace without blocking, returns False if a trace was dropped"
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        self.dropped += 1
+        if self.drop_oldest:
+            try:
+                self.rejected.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.rejected.append(item)
+        else:
+            self.rejected.append(item)
+        return False
+
+    def export(self, item: dict) -> None:
+        # source: https://langfuse.com/docs/sdk/python/low-level-sdk
+        trace = self.langfuse.trace(**item["trace"])
+        span = trace.span(**item["span"])
+        span.generation(**item["generation"])
+
+    def resize(self, max_size: int) -> None:
+        "change the size of the queue, the traces already queued are kept"
+        with self.queue.mutex:
+            self.queue.maxsize = max_size
+            self.queue.not_full.notify_all()
+
+    def report(self, item: dict, ok: bool) -> None:
+        if self.on_result is None:
+            return
+        try:
+            self.on_result(item, ok)
+        except Exception as e:
+            print(f"LangfuseFilter: Exporter: error when reporting trace: '{e}'")
+
+    def run(self) -> None:
+        pending = []
+        last_flush = time.time()
+        while True:
+            timeout = max(0, self.flush_interval - (time.time() - last_flush))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            while self.rejected:
+                self.report(self.rejected.popleft(), False)
+
+            if item is not None:
+                try:
+                    self.export(item)
+                    pending.append(item)
+                except Exception as e:
+                    print(f"LangfuseFilter: Exporter: error when exporting trace: '{e}'")
+                    self.report(item, False)
+
+            if len(pending) >= self.batch_size or time.time() - last_flush >= self.flush_interval:
+                if pending:
+                    try:
+                        self.langfuse.flush()
+                        self.exported += len(pending)
+                        ok = True
+                    except Exception as e:
+                        print(f"LangfuseFilter: Exporter: error when flushing {len(pending)} traces: '{e}'")
+                        ok = False
+                    for flushed in pending:
+                        self.report(flushed, ok)
+                pending = []
+                last_flush = time.time()
 
-LOCK_FILENAME = "./langfuse_filter.lock"
-BUFFER = Path("./langfuse_filter.buffer")
-with FileLock(LOCK_FILENAME, timeout=1):
-    BUFFER.touch()
-    if BUFFER.read_text() == "":
-        BUFFER.write_text("{}")
 
 class Filter:
-    VERSION="1.0.1"
+    VERSION="1.5.3"
 
     class Valves(BaseModel):
         priority: int = Field(
@@ -58,11 +305,59 @@ class Filter:
             description="langfuse_secret_key",
             required=True,
         )
+        export_queue_size: int = Field(
+            default=1000,
+            description="Maximum number of traces waiting to be sent to langfuse",
+        )
+        export_batch_size: int = Field(
+            default=20,
+            description="Flush langfuse after that many traces",
+        )
+        export_flush_interval: float = Field(
+            default=5.0,
+            description="Flush langfuse at least every that many seconds (at least 0.1)",
+        )
+        export_drop_oldest: bool = Field(
+            default=True,
+            description="When the queue is full, True to drop the oldest trace, False to drop the new one",
+        )
+        delta_messages: bool = Field(
+            default=False,
+            description="True to send the whole history only once per chat: the next traces only contain the new messages, a reference to the previous trace, and the messages and metadata are only attached to the generation instead of being repeated in the trace and span",
+        )
+        history_ttl: int = Field(
+            default=7 * 24 * 3600,
+            description="Number of seconds after which we forget what was sent for a chat (its whole history is then sent again)",
+        )
+        buffer_ttl: int = Field(
+            default=3600,
+            description="Number of seconds after which the start time of a request whose outlet was never called is forgotten",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
         self.debug = self.valves.debug
-        self.lock = FileLock(LOCK_FILENAME, timeout=5)
+        self.store = ChatStore(
+            path=BUFFER,
+            ttl=self.valves.buffer_ttl,
+            history_ttl=self.valves.history_ttl,
+        )
+        # connection of the exporter thread, that confirms the histories
+        self.export_store = ChatStore(
+            path=BUFFER,
+            ttl=self.valves.buffer_ttl,
+            history_ttl=self.valves.history_ttl,
+        )
+
+    async def on_valves_updated(self):
+        for store in (self.store, self.export_store):
+            store.ttl = self.valves.buffer_ttl
+            store.history_ttl = self.valves.history_ttl
+        if hasattr(self, "exporter"):
+            self.exporter.batch_size = self.valves.export_batch_size
+            self.exporter.flush_interval = max(MIN_FLUSH_INTERVAL, self.valves.export_flush_interval)
+            self.exporter.resize(self.valves.export_queue_size)
+            self.exporter.drop_oldest = self.valves.export_drop_oldest
 
     async def log(self, message: str, force: bool = False) -> None:
         if self.valves.debug or force:
@@ -78,6 +373,14 @@ class Filter:
                 secret_key=self.valves.langfuse_secret_key,
                 # debug=self.valves.debug,  # a bit too verbose
             )
+            self.exporter = Exporter(
+                langfuse=self.langfuse,
+                max_size=self.valves.export_queue_size,
+                batch_size=self.valves.export_batch_size,
+                flush_interval=self.valves.export_flush_interval,
+                drop_oldest=self.valves.export_drop_oldest,
+                on_result=self.on_export_result,
+            )
         except Exception as e:
             await self.log(f"Failed to init langfuse: '{e}'", force=True)
             raise Exception(f"Failed to init langfuse: '{e}'", force=True)
@@ -94,22 +397,10 @@ class Filter:
             await self.__init_langfuse__()
 
         chat_id = __metadata__["chat_id"]
-        with self.lock:
-            content = BUFFER.read_text()
-            try:
-                buffer = json.loads(content)
-                assert isinstance(buffer, dict), f"Not a dict but {type(buffer)}"
-            except Exception as e:
-                self.log(f"LangfuseFilterInlet: Error when loading json: '{e}'\nBuffer: {content}")
-                await self.emitter.error_update(f"LangfuseFilterInlet: Error when loading json: '{e}'\nBuffer: {content}")
-                buffer = {}
-
-            if chat_id in buffer:
-                self.log(f"INLET ERROR: buffer already contains chat_id '{chat_id}': '{buffer[chat_id]}'", force=True)
-
-            self.log(f"Started timer for chat_id {chat_id}")
-            buffer[chat_id] = time.time()
-            BUFFER.write_text(json.dumps(buffer))
+        previous = self.store.put(chat_id, time.time())
+        if previous is not None:
+            await self.log(f"INLET ERROR: buffer already contains chat_id '{chat_id}': '{previous}'", force=True)
+        await self.log(f"Started timer for chat_id {chat_id}")
         return body
 
     async def outlet(
@@ -144,102 +435,131 @@ class Filter:
         model_parameters = self.flatten_dict(__model__)
         metadata["files"] = self.flatten_dict(__files__)
 
-        with self.lock:
-            content = BUFFER.read_text()
-            try:
-                buffer = json.loads(content)
-                assert isinstance(buffer, dict), f"Not a dict but {type(buffer)}"
-            except Exception as e:
-                await self.log(f"LangfuseFilterOutlet: Error when loading json: '{e}'\nBuffer: {content}")
-                await self.emitter.error_update(f"LangfuseFilterOutlet: Error when loading json: '{e}'\nBuffer: {content}")
-                buffer = {}
-
-            if chat_id not in buffer:
-                await self.log(f"OUTLET ERROR: buffer is missing chat_id '{chat_id}'", force=True)
-                t_start = None
-            else:
-                t_start = datetime.fromtimestamp(float(buffer[chat_id]))
-
-            # source: https://langfuse.com/docs/sdk/python/low-level-sdk
-
-            trace = self.langfuse.trace(
-                # id=chat_id,
+        t_start = self.store.pop(chat_id)
+        if t_start is None:
+            await self.log(f"OUTLET ERROR: buffer is missing chat_id '{chat_id}'", force=True)
+        else:
+            t_start = datetime.fromtimestamp(t_start)
+
+        trace_id = str(uuid.uuid4())
+        messages = body["messages"]
+        input_messages = messages[:-1]
+        if self.valves.delta_messages:
+            # only send what the previous trace of this chat did not contain
+            history = self.store.get_history(chat_id)
+            if history is not None:
+                n_sent, digest, previous_trace_id = history
+                if n_sent <= len(input_messages) and self.digest(messages[:n_sent]) == digest:
+                    input_messages = input_messages[n_sent:]
+                    metadata["ow_previous_trace_id"] = previous_trace_id
+                    metadata["ow_history_offset"] = n_sent
+                else:
+                    await self.log(f"History of chat_id {chat_id} was edited, sending it whole")
+            # stored by on_export_result once langfuse received the trace
+            history = (chat_id, len(messages), self.digest(messages), trace_id)
+            # the messages and metadata are only attached to the generation
+            duplicated = {}
+        else:
+            history = None
+            duplicated = dict(
+                input=input_messages,
+                output=messages[-1],
+                metadata=metadata,
+            )
+
+        accepted = self.exporter.put({
+            "trace": dict(
+                id=trace_id,
                 # name="OpenWebuiLangfuseFilter",
                 name = "open-webui_chat-trace",
-                input=body["messages"][:-1],
-                output=body["messages"][-1],
-                metadata=metadata,
                 user_id=__user__["name"],
                 # session_id=__metadata__["session_id"],
                 session_id=chat_id,
                 version=self.VERSION,
                 tags=["open-webui", "langfuse_filter"],
                 public=False,
-            )
-            span = trace.span(
+                **duplicated,
+            ),
+            "span": dict(
                 # id=__metadata__["message_id"],
                 start_time=t_start,
                 end_time=t_end,
                 name="open-webui-chat-trace-span",
-                metadata=metadata,
-                input=body["messages"][:-1],
-                output=body["messages"][-1],
                 version=self.VERSION,
-            )
-            generation = span.generation(
+                **duplicated,
+            ),
+            "generation": dict(
                 # id=__metadata__["message_id"],
-                name=body["messages"][-1]["content"][:100],
+                name=messages[-1]["content"][:100],
                 start_time=t_start,
                 end_time=t_end,
                 model= __model__['info']["base_model_id"],
                 model_parameters=model_parameters,
-                input=body["messages"][:-1],
-                output=body["messages"][-1],
+                input=input_messages,
+                output=messages[-1],
                 metadata=metadata,
                 version=self.VERSION,
-            )
-
-            self.langfuse.flush()
-
-            if chat_id in buffer and buffer[chat_id] == t_start:
-                del buffer[chat_id]
+            ),
+            "history": history,
+        })
+        if not accepted:
+            await self.log(f"Export queue full, {self.exporter.dropped} traces dropped so far")
 
-            BUFFER.write_text(json.dumps(buffer))
-
-        await self.log(f"Done with langfuse with chat_id {chat_id}")
+        await self.log(f"Queued langfuse trace for chat_id {chat_id}")
         return body
 
-    def flatten_dict(self, input: dict) -> dict:
+    def on_export_result(self, item: dict, ok: bool) -> None:
+        "called by the exporter thread: only point to traces that langfuse received"
+        if item["history"] is None:
+            return
+        chat_id = item["history"][0]
+        if ok:
+            self.export_store.set_history(*item["history"])
+        else:
+            # the next traces would point to a missing one, send the whole history again
+            self.export_store.clear_history(chat_id)
+
+    def digest(self, messages: List[dict]) -> str:
+        "hash of a list of messages, to notice edits of the history"
+        return hashlib.sha256(
+            json.dumps(messages, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def flatten_dict(self, input: dict, max_depth: int = 10, max_keys: int = 1000) -> dict:
+        """Flatten the nested dicts into 'parent_child' keys in a single pass,
+        appending '_' to keys that already exist. Dicts deeper than max_depth
+        or found after max_keys keys are turned into strings."""
         if not isinstance(input, dict):
             return input
-        
+
         result = input.copy()
-        while any(isinstance(v, dict) for v in result.values()):
-            dict_found = False
-            for k, v in list(result.items()):  # Create a list to avoid modification during iteration
-                if isinstance(v, dict):
-                    dict_found = True
-                    # Remove the current key-value pair
-                    del result[k]
-                    # Flatten and add the nested dictionary items
-                    for k2, v2 in v.items():
-                        new_key = f"{k}_{k2}"
-                        while new_key in result:
-                            new_key = new_key + "_"
-                        result[new_key] = v2
-                    break
-                else:
-                    # Handle non-dictionary values
-                    if isinstance(v, list):
-                        try:
-                            result[k] = json.dumps(v)  # langfuse hates lists
-                        except Exception:
-                            result[k] = str(v)
-                    else:
-                        try:
-                            json.dumps(v)  # Just test if serializable
-                        except Exception:
-                            result[k] = str(v)
+        depths = {}
+        todo = deque(k for k, v in result.items() if isinstance(v, dict))
+        while todo:
+            k = todo.popleft()
+            v = result[k]
+            depth = depths.pop(k, 1)
+            if depth > max_depth or len(result) >= max_keys:
+                result[k] = str(v)
+                continue
+            # Remove the current key-value pair
+            del result[k]
+            # Flatten and add the nested dictionary items
+            for k2, v2 in v.items():
+                new_key = f"{k}_{k2}"
+                while new_key in result:
+                    new_key = new_key + "_"
+                result[new_key] = v2
+                if isinstance(v2, dict):
+                    todo.append(new_key)
+                    depths[new_key] = depth + 1
+
+        # Handle non-dictionary values
+        for k, v in result.items():
+            if isinstance(v, (list, tuple)):
+                result[k] = to_json(v)  # langfuse hates lists
+            elif not isinstance(v, JSON_SCALARS):
+                result[k] = str(v)
 
         return result
 
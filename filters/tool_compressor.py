@@ -4,7 +4,7 @@ author: thiswillbeyourightub
 author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 git_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
-version: 1.0.0
+version: 1.4.2
 date: 2025-02-21
 license: GPLv3
 description: A Filter that makes more compact the tool calls (turn the <details> escaped html (token expensive!) into regular unescaped html, or even removed.
@@ -13,8 +13,86 @@ openwebui_url: https://openwebui.com/f/qqqqqqqqqqqqqqqqqqqq/tool_compressor
 
 from pydantic import BaseModel, Field
 from typing import Optional, Callable, Any
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
 import html
+import os
 import re
+import time
+
+TOOL_CALLS_START = '<details type="tool_calls" done="true"'
+ATTRIBUTE_REGEX = re.compile(r' (\w+)="([^"]*)"')
+TIERS = ("full", "excerpt", "stub")
+
+
+def estimate_tokens(text: str) -> int:
+    "rough number of tokens of text, about 4 characters per token"
+    return len(text) // 4
+
+
+class ToolCall:
+    "a parsed tool call block, the content and results are still escaped"
+
+    def __init__(self, tag: str, inner: str, content: Optional[str], results: Optional[str]):
+        self.tag = tag
+        self.inner = inner
+        self.content = content
+        self.results = results
+        self.handle = None  # set once the results are offloaded
+
+
+class OffloadStore:
+    """Content addressed store of the large tool results on disk.
+
+    Each result is written once as <handle>.txt where the handle is the
+    start of the sha256 of the escaped results, and its modification
+    time is refreshed each time it is stored again. The tool_results tool
+    reads them back. The files older than max_age or above max_bytes
+    in total are deleted, oldest first, at most once per minute.
+    """
+
+    def __init__(self, path: str, max_age: float, max_bytes: int):
+        self.path = Path(path)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.last_eviction = 0
+
+    def put(self, results: str) -> str:
+        "store the unescaped results and return their handle"
+        handle = hashlib.sha256(results.encode()).hexdigest()[:16]
+        file = self.path / f"{handle}.txt"
+        try:
+            # still referenced: refresh its age, evict goes by modification time
+            os.utime(file)
+        except FileNotFoundError:
+            self.path.mkdir(parents=True, exist_ok=True)
+            # write then rename so that the tool never reads half a file
+            tmp = file.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(html.unescape(results), encoding="utf-8")
+            tmp.replace(file)
+        self.evict()
+        return handle
+
+    def evict(self) -> None:
+        "delete the files that are too old or above the size limit"
+        now = time.time()
+        if now - self.last_eviction < 60:
+            return
+        self.last_eviction = now
+        files = []
+        for file in self.path.glob("*.txt"):
+            stat = file.stat()
+            if now - stat.st_mtime > self.max_age:
+                file.unlink(missing_ok=True)
+            else:
+                files.append((stat.st_mtime, stat.st_size, file))
+        total = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files):
+            if total <= self.max_bytes:
+                break
+            file.unlink(missing_ok=True)
+            total -= size
 
 
 class Filter:
@@ -29,62 +107,295 @@ class Filter:
         )
         remove_results: bool = Field(
             default=True,
-            description="Delete the results field",
+            description="Delete the results field. Ignored if progressive_results is True.",
         )
         remove_content: bool = Field(
             default=True,
             description="Delete the content field",
         )
+        cache_size: int = Field(
+            default=1000,
+            description="Number of parsed messages to remember so that the chat history is not parsed again at each turn. 0 to disable.",
+        )
+        progressive_results: bool = Field(
+            default=False,
+            description="Compress the results depending on their age instead of using remove_results: the most recent ones are kept, the older ones are shortened to an excerpt, the oldest ones are replaced by a stub.",
+        )
+        keep_last_results: int = Field(
+            default=2,
+            description="With progressive_results, number of most recent tool results kept verbatim",
+        )
+        excerpt_last_results: int = Field(
+            default=10,
+            description="With progressive_results, number of tool results after the verbatim ones that are shortened to their beginning and end",
+        )
+        excerpt_chars: int = Field(
+            default=500,
+            description="With progressive_results, number of characters kept at the beginning and at the end of the excerpts",
+        )
+        results_token_budget: int = Field(
+            default=0,
+            description="With progressive_results, maximum number of tokens of the tool results in the whole chat, older results are shortened further until it fits. 0 to disable.",
+        )
+        offload_threshold: int = Field(
+            default=0,
+            description="Tool results longer than that many tokens are stored on disk and replaced by a handle that the tool_results tool can read. 0 to disable.",
+        )
+        offload_dir: str = Field(
+            default="./tool_results",
+            description="Directory of the offloaded tool results, must be the same as in the tool_results tool",
+        )
+        offload_max_age_days: float = Field(
+            default=30,
+            description="Offloaded tool results older than that are deleted",
+        )
+        offload_max_mb: float = Field(
+            default=500,
+            description="Above that size, the oldest offloaded tool results are deleted",
+        )
 
     def __init__(self):
         self.valves = self.Valves()
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.store = None
 
-    def log(self, message: str):
-        if self.valves.debug:
-            print(f"ToolCompressor: {message}")
+    def log(self, message: str, *args):
+        "print message % args, formatted only if debug is True"
+        if not self.valves.debug:
+            return
+        if args:
+            message = message % args
+        print(f"ToolCompressor: {message}")
 
-    def compress_tool_calls(self, text: str) -> str:
-        orig_text = text
-        details = re.findall(r'<details type="tool_calls" done="true" .*?</details>', text, flags=re.DOTALL|re.MULTILINE)
-        if not details:
+    def parse_tool_calls(self, text: str) -> list:
+        "split text in a single scan into a list of str and ToolCall"
+        start = text.find(TOOL_CALLS_START)
+        if start == -1:
             self.log("No tool_calls in message")
-            return text
-
-        if len(details) > 1:
-            compressed_details = [self.compress_tool_calls(text=detail) for detail in details]
-            n = len(details)
-            for idet, (comp, det) in enumerate(zip(compressed_details, details)):
-                assert det in text, f"Couldn't find detail tag #{i}/{n}: '{det}'"
-                text = text.replace(det, comp)
-            return text
-
-        match = re.search(r'details type="tool_calls" done="true" content="([^"]*?)" results="([^"]*)"', text, flags=re.DOTALL|re.MULTILINE)
-        assert match, f"Couldn't match tool call '{text}'"
-
-        content2 = html.unescape(match.group(1))
-        results2 = html.unescape(match.group(2))
-        
-        # Replace the original content with the new format
-        text = text.replace(f' content="{match.group(1)}"', "")
-        text = text.replace(f' results="{match.group(2)}"', "")
-
-        text = text.replace("</details>", "\n")
-
-        if not self.valves.remove_content:
-            text += f"""Results: {content2}"""
-        if not self.valves.remove_results:
-            text += f"""Results: {results2}"""
-        if not text.endswith("</details>"):
-            text += "\n</details>"
-        return text
+            return [text]
+
+        parts = []
+        pos = 0
+        while start != -1:
+            tag_end = text.find(">", start)
+            close = text.find("</details>", tag_end) if tag_end != -1 else -1
+            if close == -1:
+                # unclosed block, for example a pasted part of a message: keep the rest as is
+                self.log("Unclosed tool_calls block at %d", start)
+                break
+            parts.append(text[pos:start])
+            parts.append(self.parse_tag(text[start:tag_end + 1], text[tag_end + 1:close]))
+            pos = close + len("</details>")
+            start = text.find(TOOL_CALLS_START, pos)
+        parts.append(text[pos:])
+        self.log("Parsed %d tool_calls", len(parts) // 2)
+        return parts
+
+    def parse_tag(self, tag: str, inner: str) -> Any:
+        "ToolCall of a single block given its opening tag and inner html, or the block itself if already compressed"
+        # drop the escaped fields from the tag
+        attributes = {}
+
+        def pop_field(match: re.Match) -> str:
+            if match.group(1) in ("content", "results"):
+                attributes[match.group(1)] = match.group(2)
+                return ""
+            return match.group(0)
+
+        tag = ATTRIBUTE_REGEX.sub(pop_field, tag)
+        if not attributes:
+            return tag + inner + "</details>"  # already compressed
+        return ToolCall(tag, inner, attributes.get("content"), attributes.get("results"))
+
+    def parse_cached(self, text: str) -> list:
+        "parse_tool_calls memoized in a LRU cache keyed by the hash of text"
+        if not self.valves.cache_size:
+            return self.parse_tool_calls(text)
+
+        # hash() is faster than hashlib and good enough for an in memory cache
+        key = (hash(text), len(text))
+        if key in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            parts = self.cache[key]
+            return [text] if parts is None else parts
+
+        self.cache_misses += 1
+        parts = self.parse_tool_calls(text)
+        # don't keep a reference to the messages without tool calls
+        self.cache[key] = None if len(parts) == 1 else parts
+        while len(self.cache) > self.valves.cache_size:
+            self.cache.popitem(last=False)
+        return parts
+
+    def offload(self, call: ToolCall) -> Optional[str]:
+        "handle of the offloaded results of call, or None if they are short enough"
+        if not self.valves.offload_threshold or estimate_tokens(call.results) <= self.valves.offload_threshold:
+            return None
+        if call.handle is None:
+            if self.store is None or self.store.path != Path(self.valves.offload_dir):
+                self.store = OffloadStore(
+                    path=self.valves.offload_dir,
+                    max_age=self.valves.offload_max_age_days * 86400,
+                    max_bytes=int(self.valves.offload_max_mb * 1024 * 1024),
+                )
+            call.handle = self.store.put(call.results)
+        return call.handle
+
+    def render_results(self, results: str, tier: str, handle: Optional[str] = None) -> str:
+        "results of a tool call compressed according to its tier"
+        if handle:
+            stored = f"[~{estimate_tokens(results)} tokens stored as '{handle}', call the fetch_tool_result tool to read them]"
+            if tier == "stub":
+                return f"Results: {stored}"
+            return self.render_results(results, "excerpt") + f"\n{stored}"
+        if tier == "stub":
+            return f"Results: [~{estimate_tokens(results)} tokens removed]"
+        n = self.valves.excerpt_chars
+        if tier == "excerpt" and len(results) > 2 * n:
+            # only unescape the excerpt, without the entities cut in half
+            head, tail = results[:n], results[-n:]
+            amp = head.rfind("&", -10)
+            if amp != -1 and ";" not in head[amp:]:
+                head = head[:amp]
+            semicolon = tail.find(";", 0, 10)
+            if semicolon != -1 and "&" not in tail[:semicolon]:
+                tail = tail[semicolon + 1:]
+            removed = len(results) - len(head) - len(tail)
+            return f"Results: {html.unescape(head)}\n[... ~{removed} characters removed ...]\n{html.unescape(tail)}"
+        return f"Results: {html.unescape(results)}"
+
+    def render(self, parts: list, tiers: Optional[list] = None) -> str:
+        "text of parsed parts, tiers being the tier of each ToolCall or None to use remove_results"
+        if len(parts) == 1:
+            return parts[0]
+        tiers = iter(tiers or ())
+        out = []
+        for part in parts:
+            if not isinstance(part, ToolCall):
+                out.append(part)
+                continue
+            out.append(part.tag + part.inner + "\n")
+            if not self.valves.remove_content and part.content is not None:
+                out.append(f"""Content: {html.unescape(part.content)}""")
+            tier = next(tiers, None)
+            if part.results is not None:
+                handle = self.offload(part)
+                if tier is not None:
+                    out.append(self.render_results(part.results, tier, handle))
+                elif not self.valves.remove_results:
+                    out.append(self.render_results(part.results, "full", handle))
+                elif handle:
+                    out.append(self.render_results(part.results, "stub", handle))
+            out.append("\n</details>")
+        return "".join(out)
+
+    def compress_tool_calls(self, text: str) -> str:
+        "rewrite all the tool call <details> blocks of text using remove_content and remove_results"
+        return self.render(self.parse_cached(text))
+
+    def assign_tiers(self, calls: list) -> list:
+        "tier of each ToolCall, from the oldest to the most recent, depending on its age and the token budget"
+        tiers = []
+        budget = self.valves.results_token_budget or float("inf")
+        used = 0
+        # the most recent are served first
+        for age, call in enumerate(reversed(calls)):
+            if age < self.valves.keep_last_results:
+                level = 0
+            elif age < self.valves.keep_last_results + self.valves.excerpt_last_results:
+                level = 1
+            else:
+                level = 2
+            size = estimate_tokens(call.results or "")
+            while level < 2:
+                # estimated on the escaped results, so a bit pessimistic
+                cost = size if level == 0 else min(size, self.valves.excerpt_chars // 2)
+                if used + cost <= budget:
+                    used += cost
+                    break
+                level += 1
+            tiers.append(TIERS[level])
+        return tiers[::-1]
+
+    @staticmethod
+    def message_texts(messages: list) -> list:
+        "texts of messages as (container, key), to handle the multimodal lists"
+        texts = []
+        for m in messages:
+            if isinstance(m["content"], str):
+                texts.append((m, "content"))
+            elif isinstance(m["content"], list):
+                for item in m["content"]:
+                    if isinstance(item, dict) and isinstance(item.get("text"), str):
+                        texts.append((item, "text"))
+        return texts
+
+    def render_stored(self, parts: list) -> str:
+        "text of parsed parts where the results stay escaped in the tag, so that the inlet can tier them again at each turn"
+        if len(parts) == 1:
+            return parts[0]
+        out = []
+        for part in parts:
+            if not isinstance(part, ToolCall):
+                out.append(part)
+                continue
+            tag = part.tag[:-1]
+            if not self.valves.remove_content and part.content is not None:
+                tag += f' content="{part.content}"'
+            if part.results is not None:
+                self.offload(part)
+                tag += f' results="{part.results}"'
+            out.append(tag + ">" + part.inner + "</details>")
+        return "".join(out)
+
+    def compress_messages(self, messages: list) -> dict:
+        "compress the tool calls of messages inplace, be their content a str or a multimodal list, and return statistics"
+        texts = self.message_texts(messages)
+        parsed = [self.parse_cached(container[key]) for container, key in texts]
+
+        calls = [part for parts in parsed for part in parts if isinstance(part, ToolCall)]
+        tiers = None
+        if self.valves.progressive_results:
+            tiers = self.assign_tiers([call for call in calls if call.results is not None])
+        tiers = iter(tiers or ())
+
+        stats = {"tool_calls": len(calls), "tokens_before": 0, "tokens_after": 0}
+        stats.update({tier: 0 for tier in TIERS})
+        for (container, key), parts in zip(texts, parsed):
+            if len(parts) == 1:
+                continue
+            text_tiers = None
+            if self.valves.progressive_results:
+                text_tiers = []
+                for part in parts:
+                    if isinstance(part, ToolCall):
+                        tier = next(tiers) if part.results is not None else None
+                        text_tiers.append(tier)
+                        if tier:
+                            stats[tier] += 1
+            stats["tokens_before"] += estimate_tokens(container[key])
+            container[key] = self.render(parts, text_tiers)
+            stats["tokens_after"] += estimate_tokens(container[key])
+        return stats
 
     async def inlet(
         self,
         body: dict,
+        __event_emitter__: Callable[[dict], Any] = None,
         ) -> dict:
         self.log("Inlet")
-        for im, m in enumerate(body["messages"]):
-            body["messages"][im]["content"] = self.compress_tool_calls(m["content"])
+        stats = self.compress_messages(body["messages"])
+        self.log("Cache hits: %d, misses: %d, size: %d", self.cache_hits, self.cache_misses, len(self.cache))
+        if stats["tool_calls"]:
+            saved = stats["tokens_before"] - stats["tokens_after"]
+            message = f"ToolCompressor: saved ~{saved} tokens over {stats['tool_calls']} tool calls"
+            if self.valves.progressive_results:
+                message += f" ({stats['full']} full, {stats['excerpt']} excerpts, {stats['stub']} stubs)"
+            self.log(message)
+            await EventEmitter(__event_emitter__).success_update(message)
         return body
 
     def outlet(
@@ -92,6 +403,42 @@ class Filter:
         body: dict,
         ) -> dict:
         self.log("Outlet")
-        for im, m in enumerate(body["messages"]):
-            body["messages"][im]["content"] = self.compress_tool_calls(m["content"])
+        # the previous messages were already compressed by the inlet
+        for m in reversed(body["messages"]):
+            if m["role"] != "assistant":
+                continue
+            if self.valves.progressive_results:
+                # the stored message keeps its results, their tier depends on the next turns
+                for container, key in self.message_texts([m]):
+                    container[key] = self.render_stored(self.parse_cached(container[key]))
+            else:
+                self.compress_messages([m])
+            break
         return body
+
+
+class EventEmitter:
+    def __init__(self, event_emitter: Callable[[dict], Any] = None):
+        self.event_emitter = event_emitter
+
+    async def progress_update(self, description):
+        await self.emit(description)
+
+    async def error_update(self, description):
+        await self.emit(description, "error", True)
+
+    async def success_update(self, description):
+        await self.emit(description, "success", True)
+
+    async def emit(self, description="Unknown State", status="in_progress", done=False):
+        if self.event_emitter:
+            await self.event_emitter(
+                {
+                    "type": "status",
+                    "data": {
+                        "status": status,
+                        "description": description,
+                        "done": done,
+                    },
+                }
+            )
@@ -3,14 +3,130 @@ title: WarnIfLongChat
 author: thiswillbeyourgithub
 author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
-version: 1.0.0
+version: 1.3.1
 date: 2024-08-29
 license: GPLv3
-description: A filter that adds a soft and hard limit to the number of messages in a chat.
+description: A filter that adds a soft and hard limit to the number of messages, estimated tokens and bytes of a chat, and optional per user and global rate limits.
 """
 
 from pydantic import BaseModel, Field
 from typing import Optional, Callable, Any
+from collections import OrderedDict
+from pathlib import Path
+import re
+import sqlite3
+import time
+import uuid
+
+# about one token per word or punctuation sign, and a flat cost per image
+TOKEN_REGEX = re.compile(r"\w+|[^\w\s]")
+IMAGE_TOKENS = 800
+
+
+class AdmissionStore:
+    """Token buckets and requests in flight, shared by all the uvicorn
+    workers through a sqlite database in WAL mode.
+
+    Each bucket holds up to a minute worth of its rate and refills
+    continuously. A request is admitted only if all its buckets can pay
+    for it and the in flight caps are not reached, in which case
+    everything is debited in the same transaction. Requests in flight
+    for more than inflight_timeout seconds are considered lost.
+    """
+
+    def __init__(self, path: Path, inflight_timeout: float):
+        self.path = path
+        self.inflight_timeout = inflight_timeout
+        self.conn = None  # opened on first use, not at import time
+
+    def connect(self) -> sqlite3.Connection:
+        if self.conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=5,
+                isolation_level=None,  # we handle the transactions
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS inflight (id TEXT PRIMARY KEY, user_id TEXT NOT NULL, started REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS inflight_user_id ON inflight (user_id)"
+            )
+            self.conn = conn
+        return self.conn
+
+    def admit(self, request_id: str, user_id: str, costs: dict, max_inflight: dict) -> Optional[str]:
+        """Admit the request or return why it is throttled.
+
+        costs maps a bucket key to (cost, per minute rate), max_inflight
+        maps None (global) or a user_id to the cap of requests in flight.
+        """
+        conn = self.connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM inflight WHERE started < ?", (now - self.inflight_timeout,)
+            )
+            for uid, cap in max_inflight.items():
+                if uid is None:
+                    n = conn.execute("SELECT COUNT(*) FROM inflight").fetchone()[0]
+                else:
+                    n = conn.execute(
+                        "SELECT COUNT(*) FROM inflight WHERE user_id = ?", (uid,)
+                    ).fetchone()[0]
+                if n >= cap:
+                    conn.execute("ROLLBACK")
+                    who = "all users" if uid is None else "you"
+                    return f"too many requests in progress for {who} ({n}/{cap}), retry when one is done"
+
+            levels = {}
+            for key, (cost, rate) in costs.items():
+                row = conn.execute(
+                    "SELECT level, updated FROM buckets WHERE key = ?", (key,)
+                ).fetchone()
+                level = rate if row is None else min(rate, row[0] + (now - row[1]) * rate / 60)
+                # a request costing more than the whole bucket waits for a full bucket
+                cost = min(cost, rate)
+                if level < cost:
+                    conn.execute("ROLLBACK")
+                    wait = (cost - level) * 60 / rate
+                    return f"rate limit '{key}' reached, retry in {wait:.0f}s"
+                levels[key] = level - cost
+
+            conn.executemany(
+                "INSERT OR REPLACE INTO buckets (key, level, updated) VALUES (?, ?, ?)",
+                [(key, level, now) for key, level in levels.items()],
+            )
+            if max_inflight:
+                # only tracked when capped, the outlet releases it only then
+                conn.execute(
+                    "INSERT OR REPLACE INTO inflight (id, user_id, started) VALUES (?, ?, ?)",
+                    (request_id, user_id, now),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return None
+
+    def done(self, request_id: Optional[str], user_id: str) -> None:
+        "the request is not in flight anymore, if the id is unknown the oldest of the user is removed"
+        conn = self.connect()
+        if request_id is not None and conn.execute(
+            "DELETE FROM inflight WHERE id = ?", (request_id,)
+        ).rowcount:
+            return
+        conn.execute(
+            "DELETE FROM inflight WHERE id = (SELECT id FROM inflight WHERE user_id = ? ORDER BY started LIMIT 1)",
+            (user_id,),
+        )
 
 
 class Filter:
@@ -27,27 +143,129 @@ class Filter:
             default=50,
             description="Above that many messages, flat out refuse",
         )
+        token_limit: int = Field(
+            default=0,
+            description="Number of tokens (estimated) of the chat when to start warning the user. 0 to disable.",
+        )
+        token_hard_limit: int = Field(
+            default=0,
+            description="Above that many tokens (estimated), flat out refuse. 0 to disable.",
+        )
+        bytes_limit: int = Field(
+            default=0,
+            description="Size in bytes of the text of the chat when to start warning the user. 0 to disable.",
+        )
+        bytes_hard_limit: int = Field(
+            default=0,
+            description="Above that many bytes, flat out refuse. 0 to disable.",
+        )
+        show_size: bool = Field(
+            default=True,
+            description="Show the size of the chat in the status when a token or bytes limit is set",
+        )
+        cache_size: int = Field(
+            default=10000,
+            description="Number of message sizes to remember so that only the new messages are measured at each turn",
+        )
+        user_requests_per_minute: float = Field(
+            default=0,
+            description="Maximum number of requests per minute for each user. 0 to disable.",
+        )
+        user_tokens_per_minute: float = Field(
+            default=0,
+            description="Maximum number of prompt tokens (estimated) per minute for each user. 0 to disable.",
+        )
+        global_requests_per_minute: float = Field(
+            default=0,
+            description="Maximum number of requests per minute for all users together. 0 to disable.",
+        )
+        global_tokens_per_minute: float = Field(
+            default=0,
+            description="Maximum number of prompt tokens (estimated) per minute for all users together. 0 to disable.",
+        )
+        user_max_inflight: int = Field(
+            default=0,
+            description="Maximum number of requests in progress for each user. 0 to disable.",
+        )
+        global_max_inflight: int = Field(
+            default=0,
+            description="Maximum number of requests in progress for all users together. 0 to disable.",
+        )
+        inflight_timeout: int = Field(
+            default=600,
+            description="Seconds after which a request still in progress is considered lost, for example if its outlet was never called",
+        )
+        admission_path: str = Field(
+            default="./warn_if_long_chat.admission.sqlite",
+            description="Path of the sqlite database that holds the rate limits state, shared by all the workers",
+        )
         debug: bool = Field(
             default=False, description="True to add emitter prints",
         )
 
     def __init__(self):
         self.valves = self.Valves()
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.admission = None
 
     async def on_valves_updated(self):
         assert self.valves.number_of_message > 2, "number_of_message has to be more than 2"
         assert self.valves.number_of_message_hard_limit > 5, "number_of_message_hard_limit has to be more than 5"
         assert self.valves.number_of_message_hard_limit > self.valves.number_of_message, "number_of_message_hard_limit has to be higher than number_of_message"
+        if self.valves.token_limit and self.valves.token_hard_limit:
+            assert self.valves.token_hard_limit > self.valves.token_limit, "token_hard_limit has to be higher than token_limit"
+        if self.valves.bytes_limit and self.valves.bytes_hard_limit:
+            assert self.valves.bytes_hard_limit > self.valves.bytes_limit, "bytes_hard_limit has to be higher than bytes_limit"
+
+    def text_size(self, text: str) -> tuple:
+        "estimated tokens and bytes of text, memoized in a LRU cache keyed by its hash"
+        # hash() is faster than hashlib and good enough for an in memory cache
+        key = (hash(text), len(text))
+        if key in self.cache:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.cache_misses += 1
+        size = (len(TOKEN_REGEX.findall(text)), len(text.encode()))
+        self.cache[key] = size
+        while len(self.cache) > self.valves.cache_size:
+            self.cache.popitem(last=False)
+        return size
+
+    def chat_size(self, messages: list) -> tuple:
+        "estimated tokens and bytes of the text of all messages"
+        tokens = 0
+        n_bytes = 0
+        for m in messages:
+            content = m.get("content")
+            if isinstance(content, str):
+                content = [{"text": content}]
+            if not isinstance(content, list):
+                continue
+            for item in content:
+                if isinstance(item, dict) and isinstance(item.get("text"), str):
+                    t, b = self.text_size(item["text"])
+                    tokens += t
+                    n_bytes += b
+                else:
+                    tokens += IMAGE_TOKENS
+        return tokens, n_bytes
 
     async def inlet(
         self,
         body: dict,
         __user__: Optional[dict] = None,
         __event_emitter__: Callable[[dict], Any] = None,
+        __metadata__: Optional[dict] = None,
         ) -> dict:
         # printer
         emitter = EventEmitter(__event_emitter__)
-        async def log(message: str, error: bool = False):
+        async def log(message: str, *args, error: bool = False):
+            "print if debug and emit message % args"
+            if args:
+                message = message % args
             if self.valves.debug:
                 print(f"WarnIfLongChat filter: inlet: {message}")
             if error:
@@ -57,8 +275,8 @@ class Filter:
             await em(message)
 
         if self.valves.debug:
-            await log(f"WarnIfLongChat filter: inlet: __user__ {__user__}")
-            await log(f"WarnIfLongChat filter: inlet: body {body}")
+            await log("WarnIfLongChat filter: inlet: __user__ %s", __user__)
+            await log("WarnIfLongChat filter: inlet: body %s", body)
 
 
         if len(body["messages"]) > self.valves.number_of_message_hard_limit:
@@ -68,9 +286,65 @@ class Filter:
         elif len(body["messages"]) > self.valves.number_of_message:
             await log(f"Tips: don't use more messages than {self.valves.number_of_message} in a single chat, create new chats instead.", error=True)
 
+        v = self.valves
+        size_limits = v.token_limit or v.token_hard_limit or v.bytes_limit or v.bytes_hard_limit
+        rate_limits = v.user_requests_per_minute or v.user_tokens_per_minute or v.global_requests_per_minute or v.global_tokens_per_minute or v.user_max_inflight or v.global_max_inflight
+        if not (size_limits or rate_limits):
+            return body
+        tokens, n_bytes = self.chat_size(body["messages"])
+        size = f"{len(body['messages'])} messages, ~{tokens} tokens, {n_bytes / 1000:.1f} kB"
+        if self.valves.debug:
+            await log("size: %s, cache hits: %s, misses: %s", size, self.cache_hits, self.cache_misses)
+
+        if (v.token_hard_limit and tokens > v.token_hard_limit) or (v.bytes_hard_limit and n_bytes > v.bytes_hard_limit):
+            await log(f"I refuse to answer to chats this long ({size})", error=True)
+            raise Exception(f"I refuse to answer to chats this long ({size})")
+
+        elif (v.token_limit and tokens > v.token_limit) or (v.bytes_limit and n_bytes > v.bytes_limit):
+            await log(f"Tips: this chat is getting long ({size}), create new chats instead.", error=True)
+
+        elif size_limits and self.valves.show_size:
+            await EventEmitter(__event_emitter__).success_update(f"Chat size: {size}")
+
+        if rate_limits:
+            user_id = (__user__ or {}).get("id", "unknown")
+            reason = self.admit(user_id, tokens, __metadata__)
+            if reason:
+                await log(f"Request throttled: {reason}", error=True)
+                raise Exception(f"Request throttled: {reason}")
+
         return body
 
-    def outlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
+    def admission_store(self) -> AdmissionStore:
+        path = Path(self.valves.admission_path)
+        if self.admission is None or self.admission.path != path:
+            self.admission = AdmissionStore(path=path, inflight_timeout=self.valves.inflight_timeout)
+        self.admission.inflight_timeout = self.valves.inflight_timeout
+        return self.admission
+
+    def admit(self, user_id: str, tokens: int, metadata: Optional[dict]) -> Optional[str]:
+        "debit the rate limits of user_id, returns why the request is throttled if it is"
+        v = self.valves
+        costs = {}
+        for key, cost, rate in (
+            (f"user:{user_id}:requests", 1, v.user_requests_per_minute),
+            (f"user:{user_id}:tokens", tokens, v.user_tokens_per_minute),
+            ("global:requests", 1, v.global_requests_per_minute),
+            ("global:tokens", tokens, v.global_tokens_per_minute),
+        ):
+            if rate:
+                costs[key] = (cost, rate)
+        max_inflight = {}
+        if v.user_max_inflight:
+            max_inflight[user_id] = v.user_max_inflight
+        if v.global_max_inflight:
+            max_inflight[None] = v.global_max_inflight
+        request_id = (metadata or {}).get("message_id") or str(uuid.uuid4())
+        return self.admission_store().admit(request_id, user_id, costs, max_inflight)
+
+    def outlet(self, body: dict, __user__: Optional[dict] = None, __metadata__: Optional[dict] = None) -> dict:
+        if self.valves.user_max_inflight or self.valves.global_max_inflight:
+            self.admission_store().done((__metadata__ or {}).get("message_id"), (__user__ or {}).get("id", "unknown"))
         return body
 
 
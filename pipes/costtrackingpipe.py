@@ -3,15 +3,17 @@ title: CostTrackingPipe
 author: thiswillbeyourgithub
 author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
-version: 3.1.1
+version: 3.5.2
 date: 2024-08-21
 license: GPLv3
 description: A pipe function to track user costs and remove 'thinking' blocks
 """
 
-from typing import List, Union, Generator, Iterator, Callable, Any, Optional
+from typing import List, Union, Generator, Iterator, Callable, Any, Optional, Dict, Tuple, AsyncGenerator
 from pydantic import BaseModel, Field
 import requests
+import aiohttp
+import asyncio
 import os
 import re
 import time
@@ -21,6 +23,120 @@ DEFAULT_BASE_URL = "http://127.0.0.1:4000"
 DEFAULT_CHAT_MODEL = "litellm_sonnet-3.5"
 DEFAULT_TITLE_CHAT_MODEL = "litellm_gpt-4o-mini"
 
+# literal delimiters of the thought blocks removed from the streams
+THOUGHT_STARTS = ["```thinking", "``` thinking"]
+THOUGHT_STOP = "```"
+
+# sentinels returned by decode_sse_line
+SSE_DONE = object()  # end of the stream
+SSE_SKIP = object()  # line without content (keep-alive, role only delta, etc)
+
+SSE_CONTENT_VALUE = re.compile(r'\s*:\s*"')
+
+
+def decode_sse_line(line: Union[bytes, str]) -> Union[str, object]:
+    """Return the content of the delta of the first choice of a SSE line,
+    or one of the sentinels SSE_DONE and SSE_SKIP.
+
+    When the line contains a single "content" key, located after "delta",
+    the string is read directly with json's scanstring instead of
+    materializing the whole chunk. Anything else goes through json.loads.
+    """
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    if line.startswith("data: "):
+        line = line[6:]  # Remove "data: " prefix
+    elif line.startswith("data:"):
+        line = line[5:]
+    if not line.startswith("{"):
+        if line.strip() == "[DONE]":
+            return SSE_DONE
+        return SSE_SKIP
+
+    # fast path
+    key = line.find('"content"')
+    if (
+        key != -1
+        and '"error"' not in line
+        and -1 < line.find('"delta"') < key
+        and line.find('"content"', key + 9) == -1
+    ):
+        value = SSE_CONTENT_VALUE.match(line, key + 9)
+        if value:
+            try:
+                content, _ = json.decoder.scanstring(line, value.end())
+                return content if content else SSE_SKIP
+            except json.JSONDecodeError:
+                pass
+
+    try:
+        parsed_line = json.loads(line)
+    except json.JSONDecodeError:
+        return SSE_SKIP
+
+    if (
+        "error" in parsed_line
+        and "message" in parsed_line["error"]
+        and parsed_line["error"]["message"]
+    ):
+        raise Exception(f"Error: {parsed_line['error']['message']}")
+
+    if not parsed_line.get("choices"):
+        # for example the last chunk that contains only the usage
+        return SSE_SKIP
+    try:
+        content = parsed_line["choices"][0]["delta"].get("content", "")
+    except KeyError as e:
+        raise Exception(
+            f"KeyError for parsed_line: '{e}'.\nParsed_line: '{parsed_line}'"
+        )
+    return content if content else SSE_SKIP
+
+# one pooled aiohttp session per LITELLM_BASE_URL, shared by all calls, stored
+# along with the event loop it is bound to
+SESSIONS: Dict[str, Tuple[aiohttp.ClientSession, asyncio.AbstractEventLoop]] = {}
+# tasks closing the replaced sessions, referenced until they are done
+CLOSING = set()
+
+
+async def close_when_idle(session: aiohttp.ClientSession) -> None:
+    "close a replaced session once the answers still streamed with it are released"
+    # _acquired holds the connections of the responses not released yet
+    while session.connector is not None and session.connector._acquired:
+        await asyncio.sleep(1)
+    await session.close()
+
+
+def get_session(base_url: str, pool_size: int) -> aiohttp.ClientSession:
+    "return the shared keep-alive session for base_url, creating it if needed"
+    loop = asyncio.get_running_loop()
+    if base_url in SESSIONS:
+        session, session_loop = SESSIONS[base_url]
+        if (
+            not session.closed
+            and session_loop is loop
+            and session.connector.limit == pool_size
+        ):
+            return session
+        # pool_size changed or the loop was replaced: the requests in flight
+        # keep their reference to the old session, close it after them
+        print(f"CostTrackingPipe: creating a new session for {base_url} with pool_size {pool_size}")
+        if not session.closed:
+            if session_loop is loop:
+                task = loop.create_task(close_when_idle(session))
+                CLOSING.add(task)
+                task.add_done_callback(CLOSING.discard)
+            elif session_loop.is_running():
+                asyncio.run_coroutine_threadsafe(close_when_idle(session), session_loop)
+            # else its loop is gone along with its connections
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=60),
+        # streamed answers can last way more than aiohttp's default of 5 minutes
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=30),
+    )
+    SESSIONS[base_url] = (session, loop)
+    return session
+
 
 class Pipe:
 
@@ -30,6 +146,14 @@ class Pipe:
             default=None,
             description="Dict where keys are litellm users and values are their virtual api keys (a string that will be json loaded as a dict). Leave to None if you want to load from env 'COSTTRACKINGPIPE_API_KEYS'",
         )
+        async_stream: bool = Field(
+            default=True,
+            description="True to use a non blocking aiohttp client with pooled keep-alive connections. False to use the old blocking requests client, which stalls the event loop during the whole answer.",
+        )
+        pool_size: int = Field(
+            default=100,
+            description="Maximum number of simultaneous connections to LITELLM_BASE_URL in the shared pool. Only used if async_stream is True.",
+        )
 
     class UserValves(BaseModel):
         enabled: bool = Field(default=True, description="True to enable price counting")
@@ -71,6 +195,13 @@ class Pipe:
         # Initialize rate limits
         self.valves = self.Valves()
 
+        # answers stopped by the users and estimate of the tokens it saved
+        self.cancelled = 0
+        self.tokens_saved = 0
+        # chunks of the answers streamed until the end, to estimate the savings
+        self.answers = 0
+        self.answer_chunks = 0
+
     async def on_valves_updated(self):
         """This function is called when the valves are updated."""
         # just checking the validity of the api_keys
@@ -190,27 +321,28 @@ class Pipe:
             payload = {**body, "model": model, "user": username}
 
             await prog("Waiting for response")
-            r = requests.post(
-                url=f"{self.valves.LITELLM_BASE_URL}/v1/chat/completions",
-                json=payload,
-                headers=headers,
-                stream=True,
-            )
-
-            r.raise_for_status()
-            assert r.status_code == 200, f"Invalid status code: {r.status_code}"
+            r = await self.post(payload=payload, headers=headers)
+        except Exception as e:
+            await err(f"Error: {e}")
+            raise
 
+        n_chunks = 0
+        try:
             if body["stream"]:
                 await prog("Receiving chunks")
                 if (not __user__["valves"].remove_thoughts) or (not __user__["valves"].enabled):
-                    for line in r.iter_lines():
+                    async for line in self.iter_lines(r):
+                        if line:
+                            n_chunks += 1
                         yield line
+                    self.record_answer(n_chunks)
                     return
-                buffer = ""
-                thought_pattern = re.compile(r"``` ?thinking.*?```", re.DOTALL)
-                thought_removed = False
+                stripper = ThoughtStripper(
+                    starts=THOUGHT_STARTS,
+                    stop=THOUGHT_STOP,
+                )
 
-                for line in r.iter_lines():
+                async for line in self.iter_lines(r):
                     if (
                         not __user__["valves"].debug
                         and "start_time" in locals()
@@ -218,47 +350,41 @@ class Pipe:
                     ):
                         # remove this print after 1s
                         await succ("")
-                    if line:
-                        line = line.decode("utf-8")
-                        if line.startswith("data: "):
-                            line = line[6:]  # Remove "data: " prefix
-                        if line.strip() == "[DONE]":
-                            break
-                        try:
-                            parsed_line = json.loads(line)
-                        except (json.JSONDecodeError, KeyError):
-                            continue
-
-                        content = parsed_line["choices"][0]["delta"].get("content", "")
-                        if not content:
-                            continue
-
-                        if thought_removed:
-                            yield content
-                            continue
-                        buffer += content
-                        match = thought_pattern.search(buffer)
-                        if match:
-                            # Remove the thought block
-                            buffer = buffer[: match.start()] + buffer[match.end() :]
-                            yield buffer
-                            buffer = ""
-                            thought_removed = True
-                            await succ("Removed thought block")
-                            start_time = time.time()
-
-                if not thought_removed:
+                        del start_time
+                    if not line:
+                        continue
+                    content = decode_sse_line(line)
+                    if content is SSE_DONE:
+                        break
+                    elif content is SSE_SKIP:
+                        continue
+                    n_chunks += 1
+
+                    n_removed = stripper.removed
+                    to_yield = stripper.feed(content)
+                    if to_yield:
+                        yield to_yield
+                    if stripper.removed != n_removed:
+                        await succ(f"Removed {stripper.removed} thought block")
+                        start_time = time.time()
+
+                to_yield = stripper.flush()
+                if to_yield:  # Yield any remaining content
+                    yield to_yield
+                self.record_answer(n_chunks)
+
+                if stripper.inside:
+                    await err("It seems a thought was never finished")
+                elif not stripper.removed:
                     # model didn't produce a thought (for example can happen for the chat title)
                     await succ("Thought block never found")
-                    yield buffer
-                    buffer = ""
-
-                if buffer:  # Yield any remaining content with finish_reason "stop"
-                    yield buffer
 
             else:  # return the whole text directly
                 await prog("Returning directly")
-                j = r.json()
+                if isinstance(r, aiohttp.ClientResponse):
+                    j = await r.json()
+                else:
+                    j = r.json()
                 to_yield = j["choices"][0]["message"].get("content", "")
                 yield to_yield
 
@@ -266,10 +392,151 @@ class Pipe:
                 await succ("")  # hides it
             return
 
+        except (GeneratorExit, asyncio.CancelledError):
+            # the user stopped the answer or closed the tab: abort the
+            # upstream stream right away instead of reading it until the end
+            r.close()
+            message = pprint(self.record_cancellation(body=payload, n_chunks=n_chunks))
+            # the generator is being closed: show it without waiting
+            try:
+                asyncio.get_running_loop().create_task(emitter.success_update(message))
+            except RuntimeError:  # closed outside of the event loop
+                pass
+            raise
+
         except Exception as e:
             await err(f"Error: {e}")
             raise
 
+        finally:
+            # give the connection back to the pool (or close it if the
+            # answer was not fully read)
+            if isinstance(r, aiohttp.ClientResponse):
+                r.release()
+            else:
+                r.close()
+
+    def record_cancellation(self, body: dict, n_chunks: int) -> str:
+        "keep track of the tokens that were not generated thanks to a cancellation"
+        self.cancelled += 1
+        # litellm sends about one token per chunk
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+        if max_tokens:
+            saved = max(0, int(max_tokens) - n_chunks)
+            bound = "up to"
+        elif self.answers:
+            # openwebui rarely sets max_tokens: compare to the average finished answer
+            saved = max(0, self.answer_chunks // self.answers - n_chunks)
+            bound = "about"
+        else:
+            return f"Cancelled after {n_chunks} chunks, no finished answer yet to estimate the tokens saved ({self.cancelled} cancellations)"
+        self.tokens_saved += saved
+        return f"Cancelled after {n_chunks} chunks, saved {bound} {saved} tokens (total: {self.tokens_saved} tokens over {self.cancelled} cancellations)"
+
+    def record_answer(self, n_chunks: int) -> None:
+        "keep track of the length of the answers streamed until the end"
+        self.answers += 1
+        self.answer_chunks += n_chunks
+
+    async def post(self, payload: dict, headers: dict) -> Union[aiohttp.ClientResponse, requests.Response]:
+        "send the request to litellm, using the shared session if async_stream is True"
+        url = f"{self.valves.LITELLM_BASE_URL}/v1/chat/completions"
+        if not self.valves.async_stream:
+            r = requests.post(
+                url=url,
+                json=payload,
+                headers=headers,
+                stream=True,
+            )
+            r.raise_for_status()
+            assert r.status_code == 200, f"Invalid status code: {r.status_code}"
+            return r
+
+        session = get_session(self.valves.LITELLM_BASE_URL, self.valves.pool_size)
+        r = await session.post(url=url, json=payload, headers=headers)
+        try:
+            r.raise_for_status()
+            assert r.status == 200, f"Invalid status code: {r.status}"
+        except Exception:
+            r.release()
+            raise
+        return r
+
+    async def iter_lines(self, r: Union[aiohttp.ClientResponse, requests.Response]) -> AsyncGenerator[bytes, None]:
+        "yield the lines of the response without their line endings, like requests' iter_lines"
+        if not isinstance(r, aiohttp.ClientResponse):
+            for line in r.iter_lines():
+                yield line
+            return
+        async for line in r.content:
+            yield line.rstrip(b"\r\n")
+
+
+class ThoughtStripper:
+    """Remove the thought blocks from a stream of text.
+
+    Each chunk is scanned once with str.find and only the end of the chunk
+    that could be the beginning of a delimiter is kept for the next call, so
+    memory stays bounded by the length of the delimiters and any number of
+    thought blocks can be removed.
+    """
+
+    def __init__(self, starts: List[str], stop: str):
+        assert starts and all(starts), "Empty start delimiter"
+        assert stop, "Empty stop delimiter"
+        self.starts = starts
+        self.stop = stop
+        self.inside = False  # True when in a thought block
+        self.removed = 0  # number of thought blocks removed so far
+        self.tail = ""  # possible beginning of a delimiter
+
+    def feed(self, chunk: str) -> str:
+        "return the part of chunk that can be shown to the user"
+        text = self.tail + chunk
+        self.tail = ""
+        out = []
+        pos = 0
+        while True:
+            if self.inside:
+                idx = text.find(self.stop, pos)
+                if idx == -1:
+                    self.tail = self.partial_suffix(text, pos, [self.stop])
+                    break
+                pos = idx + len(self.stop)
+                self.inside = False
+                self.removed += 1
+            else:
+                idx, length = -1, 0
+                for start in self.starts:
+                    i = text.find(start, pos)
+                    if i != -1 and (idx == -1 or i < idx or (i == idx and len(start) > length)):
+                        idx, length = i, len(start)
+                if idx == -1:
+                    self.tail = self.partial_suffix(text, pos, self.starts)
+                    out.append(text[pos:len(text) - len(self.tail)])
+                    break
+                out.append(text[pos:idx])
+                pos = idx + length
+                self.inside = True
+        return "".join(out)
+
+    def flush(self) -> str:
+        "return what was held back, to call at the end of the stream"
+        tail, self.tail = self.tail, ""
+        if self.inside:
+            return ""
+        return tail
+
+    @staticmethod
+    def partial_suffix(text: str, pos: int, delimiters: List[str]) -> str:
+        "longest end of text[pos:] that is the beginning of a delimiter"
+        longest = max(len(d) for d in delimiters) - 1
+        for n in range(min(longest, len(text) - pos), 0, -1):
+            suffix = text[-n:]
+            if any(d.startswith(suffix) for d in delimiters):
+                return suffix
+        return ""
+
 
 class EventEmitter:
     def __init__(self, event_emitter: Callable[[dict], Any] = None):
@@ -4,7 +4,7 @@ author: thiswillbeyourgithub
 author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
 date: 2024-10-11
-version: 1.5.0
+version: 1.8.2
 license: GPLv3
 description: A pipe function that automatically replaces <thinking> xml tags to display as <details> (should be obsolete now)
 """
@@ -12,6 +12,7 @@ description: A pipe function that automatically replaces <thinking> xml tags to
 from typing import Union, Generator, Iterator, Callable, Any, Optional
 from pydantic import BaseModel, Field
 import requests
+import asyncio
 import re
 import json
 
@@ -19,6 +20,84 @@ DEFAULT_BASE_URL = "http://127.0.0.1:4000"
 DEFAULT_CHAT_MODEL = "litellm_sonnet-3.5"
 DEFAULT_TITLE_CHAT_MODEL = "litellm_gpt-4o-mini"
 
+# sentinels returned by decode_sse_line
+SSE_DONE = object()  # end of the stream
+SSE_SKIP = object()  # line without content (keep-alive, role only delta, etc)
+
+SSE_CONTENT_VALUE = re.compile(r'\s*:\s*"')
+
+
+def decode_sse_line(line: Union[bytes, str]) -> Union[str, object]:
+    """Return the content of the delta of the first choice of a SSE line,
+    or one of the sentinels SSE_DONE and SSE_SKIP.
+
+    When the line contains a single "content" key, located after "delta",
+    the string is read directly with json's scanstring instead of
+    materializing the whole chunk. Anything else goes through json.loads.
+    """
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    if line.startswith("data: "):
+        line = line[6:]  # Remove "data: " prefix
+    elif line.startswith("data:"):
+        line = line[5:]
+    if not line.startswith("{"):
+        if line.strip() == "[DONE]":
+            return SSE_DONE
+        return SSE_SKIP
+
+    # fast path
+    key = line.find('"content"')
+    if (
+        key != -1
+        and '"error"' not in line
+        and -1 < line.find('"delta"') < key
+        and line.find('"content"', key + 9) == -1
+    ):
+        value = SSE_CONTENT_VALUE.match(line, key + 9)
+        if value:
+            try:
+                content, _ = json.decoder.scanstring(line, value.end())
+                return content if content else SSE_SKIP
+            except json.JSONDecodeError:
+                pass
+
+    try:
+        parsed_line = json.loads(line)
+    except json.JSONDecodeError:
+        return SSE_SKIP
+
+    if (
+        "error" in parsed_line
+        and "message" in parsed_line["error"]
+        and parsed_line["error"]["message"]
+    ):
+        raise Exception(f"Error: {parsed_line['error']['message']}")
+
+    if not parsed_line.get("choices"):
+        # for example the last chunk that contains only the usage
+        return SSE_SKIP
+    try:
+        content = parsed_line["choices"][0]["delta"].get("content", "")
+    except KeyError as e:
+        raise Exception(
+            f"KeyError for parsed_line: '{e}'.\nParsed_line: '{parsed_line}'"
+        )
+    return content if content else SSE_SKIP
+
+
+def usage_line(line: Union[bytes, str]) -> Optional[str]:
+    "the SSE line to forward as is if it carries the usage, None otherwise"
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    if '"usage"' not in line or not line.startswith("data:"):
+        return None
+    try:
+        usage = json.loads(line[5:]).get("usage")
+    except json.JSONDecodeError:
+        return None
+    return line if usage else None
+
 
 class Pipe:
 
@@ -40,16 +119,20 @@ class Pipe:
         )
         start_thought: str = Field(
             default="<thinking>",
-            description="Start of a thought block. Note that any whitespace following the pattern will be considered part of the pattern. The applied regex flags are re.DOTALL and re.MULTILINE"
+            description="Start of a thought block. This is a literal string, not a regex."
         )
         stop_thought: str = Field(
             default="</thinking>",
-            description="End of thought block Note that any whitespace preceding the pattern will be considered part of the pattern. The applied regex flags are re.DOTALL and re.MULTILINE",
+            description="End of thought block. This is a literal string, not a regex.",
         )
         cache_system_prompt: bool = Field(
             default=True,
             description="Wether to cache the system prompt, if using a claude model",
         )
+        raw_passthrough: bool = Field(
+            default=True,
+            description="If the user disabled remove_thoughts, forward the lines of litellm as is instead of decoding them",
+        )
 
     class UserValves(BaseModel):
         remove_thoughts: bool = Field(
@@ -67,18 +150,12 @@ class Pipe:
         # Initialize rate limits
         self.valves = self.Valves()
 
-        self.start_thought = re.compile(
-            self.valves.start_thought + r"\s*",
-            flags=re.DOTALL | re.MULTILINE,
-        )
-        self.stop_thought = re.compile(
-            "r\s*" + self.valves.stop_thought,
-            flags=re.DOTALL |re.MULTILINE
-        )
-        self.pattern = re.compile(
-            self.valves.start_thought + "(.*)?" + self.valves.stop_thought,
-            flags=re.DOTALL | re.MULTILINE,
-        )
+        # answers stopped by the users and estimate of the tokens it saved
+        self.cancelled = 0
+        self.tokens_saved = 0
+        # chunks of the answers streamed until the end, to estimate the savings
+        self.answers = 0
+        self.answer_chunks = 0
 
     def p(self, message: str) -> str:
         "simple printer"
@@ -95,12 +172,8 @@ class Pipe:
         api_key = api_key.strip()
         assert api_key, "Valve api_key is empty"
 
-        self.start_thought = re.compile(self.valves.start_thought)
-        self.stop_thought = re.compile(self.valves.stop_thought)
-        self.pattern = re.compile(
-            self.valves.start_thought + "(.*)?" + self.valves.stop_thought,
-            flags=re.DOTALL | re.MULTILINE,
-        )
+        assert self.valves.start_thought, "Valve start_thought is empty"
+        assert self.valves.stop_thought, "Valve stop_thought is empty"
 
     async def pipe(
         self,
@@ -212,6 +285,9 @@ class Pipe:
 
             payload = body.copy()
             payload["model"] = model
+            if self.valves.cache_system_prompt and can_be_cached and not title:
+                # to see the cache reads in the usage of the last chunk
+                payload.setdefault("stream_options", {"include_usage": True})
 
             # also sets the user and if it's a titlecreator or not
             if "user" not in body:
@@ -261,106 +337,84 @@ class Pipe:
                 raise Exception(f"Error when creating requests: ") from e
             assert r.status_code == 200, f"Invalid status code: {r.status_code}"
 
-            yielded = ""
+            yielded = False
+            n_chunks = 0
 
             if not title:
                 await prog("Receiving chunks")
 
                 # disabled, return all directly
                 if not __user__["valves"].remove_thoughts:
-                    for line in r.iter_lines():
-                        try:
-                            content = self.parse_chunk(line)
-                        except Exception as e:
-                            es = str(e)
-                            if es == "DONE":
+                    if self.valves.raw_passthrough:
+                        for line in r.iter_lines():
+                            if line:
+                                n_chunks += 1
+                            yield line
+                    else:
+                        for line in r.iter_lines():
+                            try:
+                                content = self.parse_chunk(line)
+                            except Exception as e:
+                                raise Exception("Error when parsing chunk: ") from e
+                            if content is SSE_DONE:
                                 break
-                            elif es == "CONTINUE":
+                            elif content is SSE_SKIP:
+                                # forward the usage to the stream hook of the filters
+                                usage = usage_line(line)
+                                if usage:
+                                    yield usage
                                 continue
-                            else:
-                                raise Exception("Error when parsing chunk: ") from e
-                        yielded += content
-                        yield content
+                            n_chunks += 1
+                            yielded = True
+                            yield content
+                    self.record_answer(n_chunks)
                     if clear_emitter:
                         await succ("")  # hides it
                     return
 
-                buffer = ""
-                len_start_thought = int(1.5 * len(self.valves.start_thought))
+                transformer = ThoughtTransformer(
+                    start=self.valves.start_thought,
+                    stop=self.valves.stop_thought,
+                    open_with="\n\n<details>\n<summary>Reasonning</summary>\n\n",
+                    close_with="\n\n</details>\n",
+                )
 
-                # remove thoughts
-                thought_removed = 0
                 for line in r.iter_lines():
                     if not line:
                         continue
 
-                    try:
-                        content = self.parse_chunk(line)
-                    except Exception as e:
-                        e = str(e)
-                        if e == "DONE":
-                            break
-                        elif e == "CONTINUE":
-                            continue
-                        else:
-                            raise
-                    buffer += content
-
-                    match = self.pattern.search(buffer)
-                    if match:  # Remove the thought block
-                        section = match.group()
-                        bef, buffer = buffer.split(section, 1)
-                        yielded += bef
-                        yield bef
-                        section = self.start_thought.sub("\n\n<details>\n<summary>Reasonning</summary>\n\n", section)
-                        section = self.stop_thought.sub("\n\n</details>\n", section)
-                        yielded += section
-                        yield section
-                        thought_removed += 1
-                        await succ(f"Removed {thought_removed} thought block")
-
-                    if buffer:
-                        # remove ulterior thought blocks
-                        start_match = self.start_thought.search(buffer)
-                        if start_match:
-                            await prog(
-                                f"Waiting for thought n°{thought_removed + 1} to finish"
-                            )
-
-                        # TODO: actually the start_thought is not of the same length as its pattern but in most cases it's a good upper bound
-                        elif len(buffer) > len_start_thought:
-                            to_yield = buffer[:-len_start_thought]
-                            buffer = buffer[-len_start_thought:]
-                            yielded += to_yield
-                            yield to_yield
-
-                if buffer:  # Yield any remaining content with finish_reason "stop"
-                    match = self.pattern.search(buffer)
-                    if match:
-                        section = match.group()
-                        bef, buffer = buffer.split(section, 1)
-                        yielded += bef
-                        yield bef
-                        section = self.start_thought.sub("\n\n<details>\n<summary>Reasonning</summary>\n\n", section)
-                        section = self.stop_thought.sub("\n\n</details>\n", section)
-                        yielded += section
-                        yield section
-
-                        thought_removed += 1
-                        yielded += buffer
-                        yield buffer
-                        await succ(f"Removed {thought_removed} thought block")
-
-                    elif self.start_thought.search(buffer):
-                        await err("It seems a thought was never finished")
-                        yielded += buffer
-                        yield buffer
-                    else:
-                        # await succ(f"Was waiting for a buffer bit: {buffer}")
-                        yielded += buffer
-                        yield buffer
-
-                if not thought_removed:
+                    content = self.parse_chunk(line)
+                    if content is SSE_DONE:
+                        break
+                    elif content is SSE_SKIP:
+                        usage = usage_line(line)
+                        if usage:
+                            yield usage
+                        continue
+                    n_chunks += 1
+
+                    inside, n_closed = transformer.inside, transformer.closed
+                    to_yield = transformer.feed(content)
+                    if to_yield:
+                        yielded = True
+                        yield to_yield
+                    if transformer.closed != n_closed:
+                        await succ(f"Removed {transformer.closed} thought block")
+                    if transformer.inside and not inside:
+                        await prog(
+                            f"Waiting for thought n°{transformer.closed + 1} to finish"
+                        )
+
+                unfinished = transformer.inside
+                to_yield = transformer.flush()
+                if to_yield:  # Yield any remaining content
+                    yielded = True
+                    yield to_yield
+                self.record_answer(n_chunks)
+
+                if unfinished:
+                    await err("It seems a thought was never finished")
+                elif not transformer.closed:
                     # model didn't produce a thought (for example can happen for the chat title)
                     await err("Thought block never found")
 
@@ -368,7 +422,7 @@ class Pipe:
                 await prog("Returning directly")
                 j = r.json()
                 to_yield = j["choices"][0]["message"].get("content", "")
-                yielded += to_yield
+                yielded = bool(to_yield)
                 yield to_yield
 
             assert yielded, "No text to show"
@@ -377,6 +431,19 @@ class Pipe:
                 await succ("")  # hides it
             return
 
+        except (GeneratorExit, asyncio.CancelledError):
+            # the user stopped the answer or closed the tab: abort the
+            # upstream stream right away instead of reading it until the end
+            if "r" in locals():
+                r.close()
+                message = self.p(self.record_cancellation(body=payload, n_chunks=n_chunks))
+                # the generator is being closed: show it without waiting
+                try:
+                    asyncio.get_running_loop().create_task(emitter.success_update(message))
+                except RuntimeError:  # closed outside of the event loop
+                    pass
+            raise
+
         except Exception as e:
             if "err" in locals():
                 await err(f"Error: {e}")
@@ -384,34 +451,95 @@ class Pipe:
                 yield f"An error has occured:\n---\n{e}\n---"
             raise
 
-    def parse_chunk(self, line) -> str:
-        line = line.decode("utf-8")
-        if line.startswith("data: "):
-            line = line[6:]  # Remove "data: " prefix
-        if line.strip() == "[DONE]":
-            raise Exception("DONE")  # triggers a break
-        try:
-            parsed_line = json.loads(line)
-        except (json.JSONDecodeError, KeyError):
-            raise Exception("CONTINUE")
-
-        if (
-            "error" in parsed_line
-            and "message" in parsed_line["error"]
-            and parsed_line["error"]["message"]
-        ):
-            raise Exception(f"Error: {parsed_line['error']['message']}")
-
-        try:
-            content = parsed_line["choices"][0]["delta"].get("content", "")
-        except KeyError as e:
-            raise Exception(
-                f"KeyError for parsed_line: '{e}'.\nParsed_line: '{parsed_line}'"
-            )
-
-        if not content:
-            raise Exception("CONTINUE")
-        return content
+        finally:
+            if "r" in locals():
+                r.close()
+
+    def record_cancellation(self, body: dict, n_chunks: int) -> str:
+        "keep track of the tokens that were not generated thanks to a cancellation"
+        self.cancelled += 1
+        # litellm sends about one token per chunk
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+        if max_tokens:
+            saved = max(0, int(max_tokens) - n_chunks)
+            bound = "up to"
+        elif self.answers:
+            # openwebui rarely sets max_tokens: compare to the average finished answer
+            saved = max(0, self.answer_chunks // self.answers - n_chunks)
+            bound = "about"
+        else:
+            return f"Cancelled after {n_chunks} chunks, no finished answer yet to estimate the tokens saved ({self.cancelled} cancellations)"
+        self.tokens_saved += saved
+        return f"Cancelled after {n_chunks} chunks, saved {bound} {saved} tokens (total: {self.tokens_saved} tokens over {self.cancelled} cancellations)"
+
+    def record_answer(self, n_chunks: int) -> None:
+        "keep track of the length of the answers streamed until the end"
+        self.answers += 1
+        self.answer_chunks += n_chunks
+
+    def parse_chunk(self, line: bytes) -> Union[str, object]:
+        "return the content of a line, or the sentinel SSE_DONE or SSE_SKIP"
+        return decode_sse_line(line)
+
+
+class ThoughtTransformer:
+    """Replace the delimiters of the thought blocks in a stream of text.
+
+    Each chunk is scanned once with str.find and only the end of the chunk
+    that is exactly the beginning of the delimiter we are waiting for is
+    held back, so memory stays bounded by the length of the delimiters
+    whatever the length of the answer.
+    """
+
+    def __init__(self, start: str, stop: str, open_with: str, close_with: str):
+        assert start, "Empty start delimiter"
+        assert stop, "Empty stop delimiter"
+        self.start = start
+        self.stop = stop
+        self.open_with = open_with
+        self.close_with = close_with
+        self.inside = False  # True when in a thought block
+        self.closed = 0  # number of thought blocks closed so far
+        self.tail = ""  # possible beginning of a delimiter
+
+    def feed(self, chunk: str) -> str:
+        "return the transformed part of chunk that can be shown to the user"
+        text = self.tail + chunk
+        self.tail = ""
+        out = []
+        pos = 0
+        while True:
+            delimiter = self.stop if self.inside else self.start
+            idx = text.find(delimiter, pos)
+            if idx == -1:
+                self.tail = self.partial_suffix(text, pos, delimiter)
+                out.append(text[pos:len(text) - len(self.tail)])
+                break
+            out.append(text[pos:idx])
+            pos = idx + len(delimiter)
+            if self.inside:
+                out.append(self.close_with)
+                self.closed += 1
+            else:
+                out.append(self.open_with)
+            self.inside = not self.inside
+        return "".join(out)
+
+    def flush(self) -> str:
+        "return what was held back and close an unfinished block, to call at the end of the stream"
+        tail, self.tail = self.tail, ""
+        if self.inside:
+            self.inside = False
+            return tail + self.close_with
+        return tail
+
+    @staticmethod
+    def partial_suffix(text: str, pos: int, delimiter: str) -> str:
+        "longest end of text[pos:] that is the beginning of delimiter"
+        for n in range(min(len(delimiter) - 1, len(text) - pos), 0, -1):
+            if delimiter.startswith(text[-n:]):
+                return text[-n:]
+        return ""
 
 
 class EventEmitter:
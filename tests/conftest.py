@@ -0,0 +1,64 @@
+import asyncio
+import importlib.util
+import json
+import threading
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+
+ROOT = Path(__file__).parent.parent
+N_CHUNKS = 100
+
+
+def load_plugin(relpath: str):
+    "import a single file plugin the way Open WebUI does, by path"
+    path = ROOT / relpath
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def plugin():
+    return load_plugin
+
+
+@pytest.fixture(scope="session")
+def server():
+    "stand-in for litellm that streams N_CHUNKS chunks, and counts the streams closed before the end"
+    state = {"closed": 0}
+
+    async def handler(request):
+        body = await request.json()
+        if not body.get("stream"):
+            return web.json_response({"choices": [{"message": {"content": "title"}}]})
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        try:
+            for i in range(N_CHUNKS):
+                chunk = {"choices": [{"delta": {"content": f"tok{i} "}}]}
+                await resp.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+                await asyncio.sleep(0.005)
+            await resp.write(b"data: [DONE]\n\n")
+        except (ConnectionResetError, asyncio.CancelledError):
+            state["closed"] += 1
+            raise
+        return resp
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handler)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{port}", state
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
@@ -0,0 +1,32 @@
+import asyncio
+
+
+def test_static_metadata_is_not_shared(plugin):
+    module = plugin("filters/add_metadata.py")
+    f = module.Filter()
+    f.valves = f.Valves(
+        compact_metadata=True,
+        extra_tags=["static"],
+        extra_metadata='{"team": {"members": ["a"]}}',
+    )
+    asyncio.run(f.on_valves_updated())
+
+    def request():
+        body = {"messages": [{"role": "user", "content": "hi"}], "metadata": {}}
+        return asyncio.run(f.inlet(body, __metadata__={"chat_id": "c", "message_id": "m"}))
+
+    body = request()
+    # what the title generation of the remove_thinking pipe does
+    body["metadata"]["tags"].append("title_creator")
+    body["metadata"]["team"]["members"].append("b")
+
+    # openwebui creates a new Valves object at each request
+    f.valves = f.Valves(**f.valves.model_dump())
+    body = request()
+    assert body["metadata"]["tags"] == ["static"]
+    assert body["metadata"]["team"] == {"members": ["a"]}
+
+
+def test_version_matches_the_header(plugin):
+    module = plugin("filters/add_metadata.py")
+    assert f"version: {module.Filter.VERSION}\n" in module.__doc__
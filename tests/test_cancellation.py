@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+import pytest
+
+from conftest import N_CHUNKS
+
+
+def make_pipe(plugin, relpath: str, url: str, monkeypatch):
+    module = plugin(relpath)
+    pipe = module.Pipe()
+    if relpath.endswith("costtrackingpipe.py"):
+        monkeypatch.setenv("COSTTRACKINGPIPE_API_KEYS", '{"default": "key"}')
+        pipe.valves = pipe.Valves(LITELLM_BASE_URL=url, async_stream=True)
+    else:
+        pipe.valves = pipe.Valves(litellm_base_url=url, api_key="key")
+    user = {"name": "user", "email": "u@x", "valves": pipe.UserValves()}
+    return pipe, user
+
+
+@pytest.mark.parametrize("relpath", ["pipes/costtrackingpipe.py", "pipes/hide_thinking.py"])
+@pytest.mark.parametrize("max_tokens", [None, 1000])
+def test_cancellation_closes_upstream(plugin, server, monkeypatch, relpath, max_tokens):
+    url, state = server
+    pipe, user = make_pipe(plugin, relpath, url, monkeypatch)
+    statuses = []
+
+    async def emit(event):
+        statuses.append(event["data"]["description"])
+
+    def body():
+        b = {"stream": True, "messages": [{"role": "user", "content": "hi"}]}
+        if max_tokens:
+            b["max_tokens"] = max_tokens
+        return b
+
+    async def main():
+        # one answer read until the end, then one stopped by the user
+        async for _ in pipe.pipe(body(), user, emit):
+            pass
+        closed = state["closed"]
+        gen = pipe.pipe(body(), user, emit)
+        n = 0
+        async for _ in gen:
+            n += 1
+            if n == 5:
+                break
+        await gen.aclose()
+        deadline = time.time() + 2
+        while state["closed"] == closed and time.time() < deadline:
+            await asyncio.sleep(0.01)
+        assert state["closed"] > closed, "upstream stream never closed"
+        # let the status be emitted
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    assert pipe.cancelled == 1
+    expected = max_tokens or N_CHUNKS
+    # the answers do not start exactly with the first chunk
+    assert expected - 10 <= pipe.tokens_saved <= expected - 5
+    assert any(s.startswith("Cancelled after") for s in statuses), statuses
@@ -0,0 +1,212 @@
+import asyncio
+import copy
+import json
+
+import pytest
+
+SYSTEM = "You are a helpful assistant. " * 300  # about 2k tokens
+TOOLS = [
+    {"type": "function", "function": {"name": f"tool_{i}", "description": "does things " * 100, "parameters": {}}}
+    for i in range(4)
+]
+
+
+def breakpoints(body: dict) -> list:
+    "(role, index) of the tools and messages that carry a cache_control"
+    found = [("tool", i) for i, t in enumerate(body.get("tools", [])) if "cache_control" in t]
+    for i, m in enumerate(body["messages"]):
+        if isinstance(m["content"], list) and any("cache_control" in c for c in m["content"]):
+            found.append((m["role"], i))
+    return found
+
+
+def chat(n: int, tools: bool = True, system: str = SYSTEM, words: int = 600) -> list:
+    "bodies of the n first turns of a chat, about 2*words tokens per message"
+    messages = [{"role": "system", "content": system}] if system else []
+    bodies = []
+    for t in range(n):
+        messages.append({"role": "user", "content": f"question {t} " * words})
+        body = {"model": "anthropic/claude-sonnet", "messages": copy.deepcopy(messages)}
+        if tools:
+            body["tools"] = copy.deepcopy(TOOLS)
+        bodies.append(body)
+        messages.append({"role": "assistant", "content": f"answer {t} " * words})
+    return bodies
+
+
+@pytest.fixture
+def run(plugin):
+    module = plugin("filters/WIP_automatic_claude_caching.py")
+
+    def run(bodies: list, chat_id: str = "chat", **valves) -> list:
+        f = module.Filter()
+        f.valves = f.Valves(verbose=False, **valves)
+        return [breakpoints(f.inlet(copy.deepcopy(b), __metadata__={"chat_id": chat_id})) for b in bodies]
+
+    return run
+
+
+def test_multi_turn_placement(run):
+    assert run(chat(3)) == [
+        [("tool", 3), ("system", 0), ("user", 1)],
+        [("tool", 3), ("system", 0), ("user", 1), ("user", 3)],
+        [("tool", 3), ("system", 0), ("user", 3), ("user", 5)],
+    ]
+
+
+def test_short_turns_after_a_long_system_prompt(run):
+    # the minimum applies to the whole prefix: every turn gets its breakpoints
+    assert run(chat(4, tools=False, words=120)) == [
+        [("system", 0), ("user", 1)],
+        [("system", 0), ("user", 1), ("user", 3)],
+        [("system", 0), ("user", 3), ("user", 5)],
+        [("system", 0), ("user", 5), ("user", 7)],
+    ]
+
+
+def test_below_the_minimum(run):
+    assert run(chat(3, tools=False, system="", words=10)) == [[], [], []]
+    # the tools are long enough, so is everything after them
+    assert run(chat(2, system="be nice", words=10)) == [
+        [("tool", 3), ("system", 0), ("user", 1)],
+        [("tool", 3), ("system", 0), ("user", 1), ("user", 3)],
+    ]
+
+
+def test_without_chat_id(plugin):
+    f = plugin("filters/WIP_automatic_claude_caching.py").Filter()
+    f.valves.verbose = False
+    body = f.inlet(copy.deepcopy(chat(2)[1]))
+    assert breakpoints(body) == [("tool", 3), ("system", 0), ("user", 3)]
+
+
+def test_edited_history(plugin):
+    f = plugin("filters/WIP_automatic_claude_caching.py").Filter()
+    f.valves.verbose = False
+    bodies = chat(4)
+    for body in bodies[:3]:
+        f.inlet(copy.deepcopy(body), __metadata__={"chat_id": "chat"})
+    edited = copy.deepcopy(bodies[3])
+    edited["messages"][2]["content"] = "edited answer " * 600
+    # the stable prefix stops at the edit
+    body = f.inlet(edited, __metadata__={"chat_id": "chat"})
+    assert breakpoints(body) == [("tool", 3), ("system", 0), ("user", 1), ("user", 7)]
+
+
+def test_valves(run):
+    assert run(chat(2, system=""), regex_model="")[1] == [("tool", 3), ("user", 0), ("user", 2)]
+    body = chat(1)[0]
+    body["model"] = "gpt-4o"
+    assert run([body]) == [[]]
+    assert run(chat(2), max_breakpoints=2)[1] == [("user", 1), ("user", 3)]
+
+
+def test_list_content(plugin):
+    f = plugin("filters/WIP_automatic_claude_caching.py").Filter()
+    f.valves.verbose = False
+    bodies = chat(2)
+    bodies[1]["messages"][3]["content"] = [
+        {"type": "text", "text": "x " * 3000},
+        {"type": "image_url", "image_url": {"url": "data:"}},
+    ]
+    f.inlet(copy.deepcopy(bodies[0]), __metadata__={"chat_id": "chat"})
+    body = f.inlet(copy.deepcopy(bodies[1]), __metadata__={"chat_id": "chat"})
+    assert body["messages"][3]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+
+
+def test_cache_usage_formats(plugin):
+    cache_usage = plugin("filters/WIP_automatic_claude_caching.py").cache_usage
+    # anthropic
+    assert cache_usage({"input_tokens": 50, "cache_read_input_tokens": 2000, "cache_creation_input_tokens": 300}) == (50, 2000, 300)
+    # openai style as sent by litellm, the prompt tokens include the cache
+    assert cache_usage({"prompt_tokens": 2350, "cache_read_input_tokens": 2000, "cache_creation_input_tokens": 300}) == (50, 2000, 300)
+    assert cache_usage({"prompt_tokens": 1000, "prompt_tokens_details": {"cached_tokens": 800}}) == (200, 800, 0)
+    assert cache_usage({"completion_tokens": 10}) is None
+    assert cache_usage(None) is None
+
+
+def test_outlet_accounting_and_summary(plugin, tmp_path):
+    f = plugin("filters/WIP_automatic_claude_caching.py").Filter()
+    f.valves = f.Valves(verbose=False, stats_path=str(tmp_path / "stats.sqlite"), persist_interval=3600)
+    statuses = []
+
+    async def emit(event):
+        statuses.append(event["data"]["description"])
+
+    def answer(chat_id: str, usage: dict, streamed: bool) -> None:
+        metadata = {"chat_id": chat_id, "message_id": f"{chat_id}{len(statuses)}"}
+        message = {"role": "assistant", "content": "hi"}
+        if streamed:
+            f.stream({"choices": [], "usage": usage}, metadata)
+        else:
+            message["usage"] = usage
+        body = {"model": "claude", "messages": [message]}
+        asyncio.run(f.outlet(body, __user__={"id": "user"}, __metadata__=metadata, __event_emitter__=emit))
+
+    answer("a", {"input_tokens": 100, "cache_creation_input_tokens": 2000}, streamed=True)
+    answer("a", {"prompt_tokens": 2150, "cache_read_input_tokens": 2000}, streamed=False)
+    answer("b", {"prompt_tokens": 300}, streamed=True)
+    assert "2000 tokens read" in statuses[1] and "claude: 1/2 requests hit the cache" in statuses[1]
+    assert "claude: 1/3 requests hit the cache" in statuses[2]
+
+    # the summary is read back from the database
+    summary = {d["key"]: d for d in f.summary("chat")}
+    assert summary["a"]["requests"] == 2 and summary["a"]["read"] == 2000 and summary["a"]["written"] == 2000
+    assert summary["b"]["hits"] == 0
+    model = f.summary("model")[0]
+    assert (model["requests"], model["hits"], model["uncached"]) == (3, 1, 550)
+    assert model["read_ratio"] == pytest.approx(2000 / 4550)
+
+    # another worker sees the same persisted counters
+    other = plugin("filters/WIP_automatic_claude_caching.py").Filter()
+    other.valves = f.valves
+    assert other.summary("user")[0]["requests"] == 3
+
+
+@pytest.mark.parametrize("remove_thoughts", [False, True])
+def test_remove_thinking_pipe_forwards_the_usage(plugin, monkeypatch, remove_thoughts):
+    pipe_module = plugin("pipes/hide_thinking.py")
+    usage = {"prompt_tokens": 2100, "completion_tokens": 3, "cache_read_input_tokens": 2000}
+    lines = [
+        b'data: {"choices": [{"delta": {"content": "Hello"}}]}',
+        b'data: {"choices": [{"delta": {}, "finish_reason": "stop"}]}',
+        b'data: {"choices": [], "usage": ' + json.dumps(usage).encode() + b"}",
+        b"data: [DONE]",
+    ]
+    sent = {}
+
+    class Response:
+        status_code = 200
+
+        def raise_for_status(self):
+            pass
+
+        def iter_lines(self):
+            return iter(lines)
+
+        def close(self):
+            pass
+
+    def post(url, json, headers, stream):
+        sent.update(json)
+        return Response()
+
+    monkeypatch.setattr(pipe_module.requests, "post", post)
+    pipe = pipe_module.Pipe()
+    pipe.valves = pipe.Valves(litellm_base_url="http://litellm", api_key="key", chat_model="anthropic/claude-sonnet", cache_system_prompt=True, raw_passthrough=False)
+    user = {"name": "user", "email": "u@x", "valves": pipe.UserValves(remove_thoughts=remove_thoughts)}
+    body = {"stream": True, "chat_id": "c", "messages": [{"role": "system", "content": "be nice"}, {"role": "user", "content": "hi"}]}
+
+    async def main():
+        return [x async for x in pipe.pipe(body, user)]
+
+    out = asyncio.run(main())
+    assert sent["stream_options"] == {"include_usage": True}
+    assert "".join(x for x in out if not x.startswith("data:")) == "Hello"
+    # open webui passes the lines starting with data: as is to the stream hook of the filters
+    (line,) = [x for x in out if x.startswith("data:")]
+    event = json.loads(line[5:])
+    f = plugin("filters/WIP_automatic_claude_caching.py").Filter()
+    f.valves.verbose = False
+    f.stream(event, {"message_id": "m"})
+    assert f.usages["m"] == usage
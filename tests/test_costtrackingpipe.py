@@ -0,0 +1,28 @@
+import asyncio
+import warnings
+
+
+def test_replaced_session_is_closed_after_its_answers(plugin, server):
+    module = plugin("pipes/costtrackingpipe.py")
+    url, _ = server
+
+    async def main():
+        old = module.get_session(url, 2)
+        r = await old.post(f"{url}/v1/chat/completions", json={"stream": True})
+        await r.content.readline()
+
+        # the pool_size changed while an answer is being streamed
+        new = module.get_session(url, 3)
+        assert new is not old and module.get_session(url, 3) is new
+        await asyncio.sleep(0.1)
+        assert not old.closed
+        async for _ in r.content:
+            pass
+        r.release()
+        await asyncio.sleep(1.5)
+        assert old.closed
+        await new.close()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", ResourceWarning)
+        asyncio.run(main())
@@ -0,0 +1,50 @@
+import asyncio
+
+ANSWER = "Hello <thinking>let me think</thinking> the answer is 42 <thinking>unfinished"
+
+
+def chunk(content, finish_reason=None) -> dict:
+    return {"choices": [{"delta": {"content": content}, "finish_reason": finish_reason}]}
+
+
+def stream(f, chunks: list, message_id: str) -> str:
+    "text shown to the user when the filter sees the chunks, ended by a null content"
+    metadata = {"message_id": message_id}
+    out = [f.stream(chunk(c), metadata)["choices"][0]["delta"]["content"] for c in chunks]
+    out.append(f.stream(chunk(None, "stop"), metadata)["choices"][0]["delta"]["content"])
+    return "".join(out)
+
+
+def test_split_delimiters(plugin):
+    f = plugin("filters/hide_thinking_filter.py").Filter()
+    f.valves.verbose = False
+    whole = stream(f, [ANSWER], "whole")
+    assert "<thinking>" not in whole and whole.count("</details>") == 2
+    # every split point, including inside the delimiters
+    for i in range(1, len(ANSWER)):
+        assert stream(f, [ANSWER[:i], ANSWER[i:]], f"split{i}") == whole
+    # one character per chunk
+    assert stream(f, list(ANSWER), "chars") == whole
+
+
+def test_outlet_skips_streamed_messages(plugin):
+    f = plugin("filters/hide_thinking_filter.py").Filter()
+    f.valves.verbose = False
+    shown = stream(f, list(ANSWER), "streamed")
+    body = {"messages": [{"role": "assistant", "content": shown}]}
+    out = asyncio.run(f.outlet(body, __metadata__={"message_id": "streamed"}))
+    assert out["messages"][-1]["content"] == shown
+
+    # a message that was not streamed is still converted by the outlet
+    body = {"messages": [{"role": "assistant", "content": "<thinking>hmm</thinking> 42"}]}
+    out = asyncio.run(f.outlet(body, __metadata__={"message_id": "other"}))
+    assert out["messages"][-1]["content"].startswith("<details>")
+
+
+def test_null_content_and_choices(plugin):
+    f = plugin("filters/hide_thinking_filter.py").Filter()
+    f.valves.verbose = False
+    f.stream(chunk("<thinking>a"), {"message_id": "m"})
+    event = f.stream(chunk(None, "stop"), {"message_id": "m"})
+    assert event["choices"][0]["delta"]["content"] == "\n\n</details>\n"
+    assert f.stream({"choices": None, "usage": {}}) == {"choices": None, "usage": {}}
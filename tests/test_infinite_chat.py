@@ -0,0 +1,69 @@
+import asyncio
+import random
+import time
+
+
+def test_recall_index_only_writes_new_messages(plugin, tmp_path):
+    module = plugin("filters/infinite_chat.py")
+    index = module.RecallIndex(path=tmp_path / "recall.sqlite", ttl=3600)
+    dropped = [{"role": "user", "content": f"message about topic{i}"} for i in range(4)]
+
+    assert index.add("chat", dropped[:2]) == 2
+    conn = index.connect()
+    changes = conn.total_changes
+    # a turn that did not drop anything new does not write
+    assert index.add("chat", dropped[:2]) == 0
+    assert conn.total_changes == changes
+
+    assert index.add("chat", dropped) == 2
+    assert [idx for idx, _, _ in index.search("chat", "topic3", 5)] == [3]
+
+    # but the chat is still kept from being evicted
+    conn.execute("UPDATE chats SET updated = ?", (time.time() - 1000,))
+    changes = conn.total_changes
+    assert index.add("chat", dropped) == 0
+    assert conn.total_changes == changes + 1
+
+
+def hit_ratio(workers: list, turns: int = 200) -> float:
+    """Share of the turns whose prompt starts with the previous prompt and
+    its answer, as needed by the prompt caches. The requests go to the
+    workers in turn, like behind a load balancer."""
+    rng = random.Random(0)
+    chat = [{"role": "system", "content": "be nice"}]
+    previous = None
+    hits = 0
+    for turn in range(turns):
+        chat.append({"role": "user", "content": "question " * rng.randint(10, 100)})
+        f = workers[turn % len(workers)]
+        body = asyncio.run(f.inlet({"messages": [dict(m) for m in chat]}, __metadata__={"chat_id": "chat"}))
+        answer = {"role": "assistant", "content": "answer " * rng.randint(50, 300)}
+        prompt = body["messages"]
+        if previous is not None and prompt[:len(previous)] == previous:
+            hits += 1
+        previous = prompt + [answer]
+        chat.append(answer)
+    return hits / (turns - 1)
+
+
+def make_workers(plugin, path, n: int, **valves) -> list:
+    "n filters sharing the database at path, like the uvicorn workers"
+    module = plugin("filters/infinite_chat.py")
+    workers = []
+    for _ in range(n):
+        f = module.Filter()
+        f.valves = f.Valves(window_path=str(path), **valves)
+        workers.append(f)
+    return workers
+
+
+def test_hysteresis_hit_ratio(plugin, tmp_path):
+    # message mode, two messages per turn: about 1 - 2 / hysteresis
+    assert hit_ratio(make_workers(plugin, tmp_path / "a.sqlite", 1, keep_messages=20)) < 0.05
+    assert 0.75 < hit_ratio(make_workers(plugin, tmp_path / "b.sqlite", 2, keep_messages=20, hysteresis=10)) < 0.85
+
+    # token mode: the same with one or several workers
+    assert hit_ratio(make_workers(plugin, tmp_path / "c.sqlite", 1, token_budget=2000)) < 0.2
+    single = hit_ratio(make_workers(plugin, tmp_path / "d.sqlite", 1, token_budget=2000, hysteresis=2000))
+    multi = hit_ratio(make_workers(plugin, tmp_path / "e.sqlite", 3, token_budget=2000, hysteresis=2000))
+    assert single > 0.8 and multi == single
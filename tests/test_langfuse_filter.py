@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+
+class FakeLangfuse:
+    "records the traces, flush fails while fail is True"
+
+    def __init__(self):
+        self.fail = False
+        self.traces = []
+
+    def trace(self, **kwargs):
+        return self
+
+    def span(self, **kwargs):
+        return self
+
+    def generation(self, **kwargs):
+        self.traces.append(kwargs)
+
+    def flush(self):
+        if self.fail:
+            raise Exception("langfuse is down")
+
+
+def test_history_only_advances_on_export(plugin, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    module = plugin("filters/langfuse_filter.py")
+    f = module.Filter()
+    f.valves = f.Valves(delta_messages=True, debug=False)
+    f.langfuse = FakeLangfuse()
+    f.exporter = module.Exporter(
+        langfuse=f.langfuse,
+        max_size=10,
+        batch_size=1,
+        flush_interval=0.1,
+        drop_oldest=True,
+        on_result=f.on_export_result,
+    )
+    messages = []
+
+    def turn(n: int) -> dict:
+        "one inlet and outlet, returns the generation once it was exported"
+        messages.extend([
+            {"role": "user", "content": f"question {n}"},
+            {"role": "assistant", "content": f"answer {n}"},
+        ])
+        meta = {"chat_id": "chat", "message_id": f"m{n}", "session_id": "s"}
+        user = {"id": "u", "name": "user", "email": "u@x"}
+        model = {"info": {"id": "model", "base_model_id": "base"}}
+        asyncio.run(f.inlet({"messages": messages}, __metadata__=meta))
+        asyncio.run(f.outlet({"messages": list(messages)}, __user__=user, __metadata__=meta, __model__=model))
+        deadline = time.time() + 5
+        while len(f.langfuse.traces) < n and time.time() < deadline:
+            time.sleep(0.01)
+        # let the thread report the flush
+        time.sleep(0.3)
+        return f.langfuse.traces[-1]
+
+    assert len(turn(1)["input"]) == 1
+    assert len(turn(2)["input"]) == 1
+
+    # the trace of turn 3 never reaches langfuse
+    f.langfuse.fail = True
+    turn(3)
+    f.langfuse.fail = False
+    generation = turn(4)
+    assert len(generation["input"]) == 7
+    assert "ow_previous_trace_id" not in generation["metadata"]
+
+    assert len(turn(5)["input"]) == 1
+
+
+def test_exporter_valves(plugin, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    module = plugin("filters/langfuse_filter.py")
+    f = module.Filter()
+    f.langfuse = FakeLangfuse()
+    f.exporter = module.Exporter(
+        langfuse=f.langfuse,
+        max_size=10,
+        batch_size=1,
+        flush_interval=0,
+        drop_oldest=True,
+    )
+    # an interval of 0 would make the thread spin
+    assert f.exporter.flush_interval == module.MIN_FLUSH_INTERVAL
+
+    f.valves = f.Valves(export_queue_size=3, export_flush_interval=-1, debug=False)
+    asyncio.run(f.on_valves_updated())
+    assert f.exporter.queue.maxsize == 3
+    assert f.exporter.flush_interval == module.MIN_FLUSH_INTERVAL
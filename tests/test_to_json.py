@@ -0,0 +1,22 @@
+import json
+
+import pytest
+
+FILES = ["filters/debug_filter.py", "filters/add_metadata.py", "filters/langfuse_filter.py", "tools/anki_tool.py"]
+
+
+@pytest.mark.parametrize("relpath", FILES)
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_to_json_never_raises(plugin, monkeypatch, relpath, use_orjson):
+    module = plugin(relpath)
+    if not use_orjson:
+        monkeypatch.setattr(module, "orjson", None)
+    assert json.loads(module.to_json({"a": object(), "b": [1, 2]}))["a"].startswith("<object object")
+    # integers larger than 64 bits make orjson fall back to json
+    assert json.loads(module.to_json({"n": 2**70})) == {"n": 2**70}
+
+    tuple_keys = {(1, 2): "x", "n": 2**70}
+    assert module.to_json(tuple_keys) == str(tuple_keys)
+    circular = {"n": 2**70}
+    circular["self"] = circular
+    assert module.to_json(circular) == str(circular)
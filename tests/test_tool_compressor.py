@@ -0,0 +1,78 @@
+import asyncio
+import html
+import json
+import os
+import time
+
+
+def block(turn: int) -> str:
+    results = html.escape(json.dumps({"turn": turn, "rows": ["<b>row</b> & more"] * 200}))
+    return (
+        f'<details type="tool_calls" done="true" id="call_{turn}" content="{html.escape("<p>hi</p>")}" results="{results}">\n'
+        "<summary>Tool Executed</summary>\n</details>"
+    )
+
+
+def results_lengths(text: str) -> list:
+    "length of each rendered Results: section"
+    return [len(part.split("\n</details>")[0]) for part in text.split("Results: ")[1:]]
+
+
+def test_unclosed_block_is_kept(plugin):
+    f = plugin("filters/tool_compressor.py").Filter()
+    f.valves.debug = False
+    text = 'see: <details type="tool_calls" done="true" content="x" results="y">\n<summary>cut'
+    assert f.compress_tool_calls(text) == text
+    closed = '<details type="tool_calls" done="true" content="x" results="y">\n<summary>a</summary>\n</details> then '
+    assert f.compress_tool_calls(closed + text).endswith(" then " + text)
+
+
+def test_progressive_results_over_turns(plugin):
+    "the outlet output is fed back to the next inlets, the older results must shrink"
+    f = plugin("filters/tool_compressor.py").Filter()
+    f.valves.debug = False
+    f.valves.progressive_results = True
+    f.valves.keep_last_results = 1
+    f.valves.excerpt_last_results = 2
+    f.valves.excerpt_chars = 100
+
+    stored = []  # the messages as Open WebUI stores them
+    for turn in range(6):
+        stored.append({"role": "user", "content": f"question {turn}"})
+        body = asyncio.run(f.inlet({"messages": json.loads(json.dumps(stored))}))
+        lengths = [n for m in body["messages"] for n in results_lengths(m["content"])]
+        if turn >= 4:
+            # one full, two excerpts, the others stubs
+            assert lengths[-1] > 4000
+            assert all(n < 400 for n in lengths[-3:-1])
+            assert all(n < 60 for n in lengths[:-3])
+        answer = {"role": "assistant", "content": block(turn) + f"\nanswer {turn}"}
+        out = f.outlet({"messages": stored + [answer]})
+        stored.append(out["messages"][-1])
+        # the stored answer keeps its results for the next turns, without the content
+        assert 'results="' in stored[-1]["content"]
+        assert 'content="' not in stored[-1]["content"]
+
+
+def test_offload_store_keeps_referenced_results(plugin, tmp_path, monkeypatch):
+    compressor = plugin("filters/tool_compressor.py")
+    tool = plugin("tools/tool_results.py").Tools()
+    tool.valves.offload_dir = str(tmp_path)
+    store = compressor.OffloadStore(path=str(tmp_path), max_age=3600, max_bytes=10**9)
+    results = html.escape("résultat → ✓ " * 100)
+
+    handle = store.put(results)
+    file = tmp_path / f"{handle}.txt"
+    old = time.time() - 3000
+    os.utime(file, (old, old))
+    # stored again by a later turn: not evicted with the old results
+    assert store.put(results) == handle
+    assert file.stat().st_mtime > old + 1000
+    store.last_eviction = 0
+    monkeypatch.setattr(compressor.time, "time", lambda: old + 4000)
+    store.evict()
+    assert file.exists()
+
+    # utf-8 whatever the locale
+    assert file.read_bytes().decode("utf-8") == html.unescape(results)
+    assert asyncio.run(tool.fetch_tool_result(handle, length=13)).startswith("résultat → ✓")
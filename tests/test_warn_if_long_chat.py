@@ -0,0 +1,63 @@
+import asyncio
+
+import aiohttp
+
+
+def make_filter(plugin, tmp_path, **valves):
+    f = plugin("filters/warn_if_long_chat.py").Filter()
+    f.valves = f.Valves(admission_path=str(tmp_path / "admission.sqlite"), **valves)
+    return f
+
+
+async def load(f, url: str, n: int) -> dict:
+    "n concurrent requests of the same user through the inlet, the stand-in backend and the outlet"
+    stats = {"admitted": 0, "throttled": 0, "inflight": 0, "max_inflight": 0}
+    user = {"id": "user"}
+
+    async def request(session, i):
+        metadata = {"message_id": f"m{i}-{id(stats)}"}
+        body = {"messages": [{"role": "user", "content": "hello there"}]}
+        try:
+            await f.inlet(body, __user__=user, __metadata__=metadata)
+        except Exception as e:
+            assert "Request throttled" in str(e)
+            stats["throttled"] += 1
+            return
+        stats["admitted"] += 1
+        stats["inflight"] += 1
+        stats["max_inflight"] = max(stats["max_inflight"], stats["inflight"])
+        async with session.post(f"{url}/v1/chat/completions", json={"stream": True}) as r:
+            async for _ in r.content:
+                pass
+        stats["inflight"] -= 1
+        f.outlet(body, __user__=user, __metadata__=metadata)
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(request(session, i) for i in range(n)))
+    return stats
+
+
+def inflight_rows(f) -> int:
+    return f.admission_store().connect().execute("SELECT COUNT(*) FROM inflight").fetchone()[0]
+
+
+def test_max_inflight_under_load(plugin, server, tmp_path):
+    url, _ = server
+    f = make_filter(plugin, tmp_path, user_max_inflight=2)
+    stats = asyncio.run(load(f, url, 10))
+    assert (stats["admitted"], stats["throttled"], stats["max_inflight"]) == (2, 8, 2)
+    assert inflight_rows(f) == 0
+    # the slots are free again once the answers are done
+    assert asyncio.run(load(f, url, 3))["admitted"] == 2
+
+
+def test_rate_limit_only_does_not_track_inflight(plugin, server, tmp_path):
+    url, _ = server
+    f = make_filter(plugin, tmp_path, user_requests_per_minute=5)
+    stats = asyncio.run(load(f, url, 10))
+    assert (stats["admitted"], stats["throttled"]) == (5, 5)
+    assert inflight_rows(f) == 0
+
+    # turning a cap on later is not affected by the previous requests
+    f.valves = f.Valves(**{**f.valves.model_dump(), "user_requests_per_minute": 0, "user_max_inflight": 2})
+    assert asyncio.run(load(f, url, 4))["admitted"] == 2
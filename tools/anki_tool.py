@@ -5,7 +5,7 @@ author_url: https://github.com/thiswillbeyourgithub
 open_webui_url: https://openwebui.com/t/qqqqqqqqqqqqqqqqqqqq/ankiflashcardcreator/
 git_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
 description: A tool to create Anki flashcards through Ankiconnect with configurable settings and event emitters for UI feedback. Not: if you want a multi user multi anki setup (each user with its own anki) you want each user to add its own private tool with as host a local url to its host via reverse proxies like ngrok that allows a url to point to a local service on the client side.
-version: 1.1.0
+version: 1.3.1
 """
 # Note to dev: don't forget to update the version number inside the Tool class!
 
@@ -13,6 +13,7 @@ import requests
 import json
 import os
 from pathlib import Path
+from collections import deque
 from typing import Callable, Any, List, Optional, Dict
 from pydantic import BaseModel, Field, model_validator
 import aiohttp
@@ -26,6 +27,29 @@ DEFAULT_TAGS="openwebui"
 DEFAULT_FIELDS_DESCRIPTION='{"Front": "The concise question", "Back": "The answer"}'
 DEFAULT_RULES="Calling this function creates a single Anki flashcard using the `fields` argument as contents.<br>You can leave some fields empty.<br>If not otherwised specified, write the flashcard in the language of the user's request.<br>You are allowed to use html formatting.<br>You cannot refer to embed media files like images, audio etc.<br>Please pay very close attention to the examples of the user and try to imitate their formulation."
 DEFAULT_EXAMPLES='[{"Front": "What is the capital of France?", "Back": "Paris"},{"Front": "What is 2+2?", "Back": "4"}]'
+JSON_TYPES = (str, int, float, bool, type(None), list, tuple)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def to_json(obj: Any, indent: bool = False) -> str:
+    """json dump obj in a single pass, turning the values of unknown types
+    into strings instead of failing. Uses orjson if it is installed."""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=str, option=option).decode()
+        except TypeError:  # for example integers larger than 64 bits
+            pass
+    try:
+        return json.dumps(obj, default=str, ensure_ascii=False, indent=2 if indent else None)
+    except (TypeError, ValueError):  # non str keys, circular references
+        return str(obj)
 
 def update_docstring(fields_description: str, rules: str, examples: str) -> str:
     rules = rules.replace("<br>", "\n").strip()
@@ -71,7 +95,7 @@ Each keys of the param `fields` must be among those fields and all values must b
 
 class Tools:
 
-    VERSION: str =  "1.1.0"
+    VERSION: str =  "1.3.1"
 
     class Valves(BaseModel):
         ankiconnect_host: str = Field(
@@ -283,7 +307,8 @@ class Tools:
                 else:
                     chat_link = ""
                 
-                metadata = json.dumps(metadata, indent=2, ensure_ascii=False)
+                # to_json turns the non serializable values inside lists into str
+                metadata = to_json(metadata, indent=True)
                 metadata = chat_link + "<br>" + '<pre><code class="language-json">' + metadata + '</code></pre>'
                 if self.valves.metadata_field in note["fields"]:
                     note["fields"][self.valves.metadata_field] += "<br>" + metadata
@@ -308,31 +333,39 @@ class Tools:
             await emitter.error_update(f"Failed to create flashcards: {str(e)}")
             return f"Failed to create flashcards: {str(e)}"
 
-    def flatten_dict(self, input: dict) -> dict:
+    def flatten_dict(self, input: dict, max_depth: int = 10, max_keys: int = 1000) -> dict:
+        """Flatten the nested dicts into 'parent_child' keys in a single pass,
+        appending '_' to keys that already exist. Dicts deeper than max_depth
+        or found after max_keys keys are turned into strings."""
         if not isinstance(input, dict):
             return input
-        
+
         result = input.copy()
-        while any(isinstance(v, dict) for v in result.values()):
-            dict_found = False
-            for k, v in list(result.items()):  # Create a list to avoid modification during iteration
-                if isinstance(v, dict):
-                    dict_found = True
-                    # Remove the current key-value pair
-                    del result[k]
-                    # Flatten and add the nested dictionary items
-                    for k2, v2 in v.items():
-                        new_key = f"{k}_{k2}"
-                        while new_key in result:
-                            new_key = new_key + "_"
-                        result[new_key] = v2
-                    break
-                else:
-                    # Handle non-dictionary values
-                    try:
-                        json.dumps(v)  # Just test if serializable
-                    except Exception:
-                        result[k] = str(v)
+        depths = {}
+        todo = deque(k for k, v in result.items() if isinstance(v, dict))
+        while todo:
+            k = todo.popleft()
+            v = result[k]
+            depth = depths.pop(k, 1)
+            if depth > max_depth or len(result) >= max_keys:
+                result[k] = str(v)
+                continue
+            # Remove the current key-value pair
+            del result[k]
+            # Flatten and add the nested dictionary items
+            for k2, v2 in v.items():
+                new_key = f"{k}_{k2}"
+                while new_key in result:
+                    new_key = new_key + "_"
+                result[new_key] = v2
+                if isinstance(v2, dict):
+                    todo.append(new_key)
+                    depths[new_key] = depth + 1
+
+        # Handle non-dictionary values
+        for k, v in result.items():
+            if not isinstance(v, JSON_TYPES):
+                result[k] = str(v)
 
         return result
 
@@ -0,0 +1,102 @@
+"""
+title: ToolResults
+author: thiswillbeyourgithub
+author_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
+funding_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters/
+git_url: https://github.com/thiswillbeyourgithub/openwebui_custom_pipes_filters
+version: 1.0.1
+license: GPLv3
+description: Companion of the tool_compressor filter: lets the LLM read back the large tool results that the filter stored on disk and replaced by a handle.
+"""
+
+from pathlib import Path
+import re
+from typing import Callable, Any
+from pydantic import BaseModel, Field
+
+HANDLE_REGEX = re.compile(r"^[0-9a-f]{16}$")
+
+
+class Tools:
+
+    VERSION: str = "1.0.1"
+
+    class Valves(BaseModel):
+        offload_dir: str = Field(
+            default="./tool_results",
+            description="Directory of the offloaded tool results, must be the same as in the tool_compressor filter",
+        )
+        max_length: int = Field(
+            default=20000,
+            description="Maximum number of characters returned by a single call",
+        )
+
+    def __init__(self):
+        self.valves = self.Valves()
+
+    async def fetch_tool_result(
+        self,
+        handle: str,
+        start: int = 0,
+        length: int = 0,
+        __event_emitter__: Callable[[dict], Any] = None,
+    ) -> str:
+        """
+        Read the full result of a previous tool call that was stored
+        to save space in the chat. The handle is the 16 characters id
+        shown next to the truncated result.
+
+        :param handle: The handle of the stored result.
+        :param start: Index of the first character to return, 0 to start from the beginning.
+        :param length: Number of characters to return, 0 for as many as allowed.
+        :return: The requested part of the result, or an error message.
+        """
+        emitter = EventEmitter(__event_emitter__)
+
+        handle = handle.strip().strip("'\"")
+        if not HANDLE_REGEX.match(handle):
+            await emitter.error_update(f"Invalid handle '{handle}'")
+            return f"Invalid handle '{handle}', it must be 16 hexadecimal characters"
+
+        file = Path(self.valves.offload_dir) / f"{handle}.txt"
+        if not file.exists():
+            await emitter.error_update(f"No stored tool result for '{handle}'")
+            return f"No stored tool result for '{handle}', it was probably deleted because it was too old"
+
+        content = file.read_text(encoding="utf-8")
+        start = max(0, int(start))
+        length = min(int(length) or self.valves.max_length, self.valves.max_length)
+        part = content[start:start + length]
+        end = start + len(part)
+
+        await emitter.success_update(f"Read characters {start} to {end} of '{handle}'")
+        if end < len(content):
+            part += f"\n[... {len(content) - end} more characters, call again with start={end} to read them]"
+        return part
+
+
+class EventEmitter:
+    def __init__(self, event_emitter: Callable[[dict], Any] = None):
+        self.event_emitter = event_emitter
+
+    async def progress_update(self, description):
+        await self.emit(description)
+
+    async def error_update(self, description):
+        await self.emit(description, "error", True)
+
+    async def success_update(self, description):
+        await self.emit(description, "success", True)
+
+    async def emit(self, description="Unknown State", status="in_progress", done=False):
+        if self.event_emitter:
+            await self.event_emitter(
+                {
+                    "type": "status",
+                    "data": {
+                        "status": status,
+                        "description": description,
+                        "done": done,
+                    },
+                }
+            )